@@ -0,0 +1,620 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# bench.py
+#
+# Benchmarks guarding the performance of crowdin_sync.py
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+from subprocess import Popen, PIPE, DEVNULL
+
+_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Modules imported by a scenario and the heavy dependencies they must not pull in
+_IMPORT_SCENARIOS = {
+    "startup": ["crowdin_sync"],
+    "gerrit": ["crowdin_sync", "gerrit"],
+}
+_HEAVY_MODULES = ["git", "lxml", "requests", "yaml"]
+
+# Metrics of a replay, compared against the baseline
+_REPLAY_METRICS = {
+    "time": ("time", "{:.2f}s"),
+    "peak_rss_mb": ("peak RSS", "{:.1f}MB"),
+    "subprocesses": ("subprocesses", "{:.0f}"),
+}
+_USERNAME = "bench"
+
+# Files the streaming cleaner has to clean exactly like the previous, in memory one
+_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+_LICENSE = "<!--\n  Copyright (C) 2026 The LineageOS Project\n-->\n"
+_XLIFF = 'xmlns:xliff="urn:oasis:names:tc:xliff:document:1.2"'
+_CLEAN_CASES = {
+    "comments": '<resources>\n    <string name="a">A</string>\n    <!-- c -->\n'
+    '    <string name="b">B</string>\n</resources>\n',
+    "minified": '<resources><string name="a">A</string><string-array name="b">'
+    "<item>1</item><item>2</item></string-array></resources>",
+    "minified_comment": '<resources><!-- c --><string name="a">A <b>B</b></string>'
+    '<string name="t" translatable="false">T</string></resources>\n',
+    "minified_product": '<resources><string name="a">A</string><string name="p" '
+    'product="tablet">P</string>\n</resources>\n',
+    "space_lines": '<resources>\n    <string name="a">A</string>\n   \n</resources>\n',
+    "spaces_before_end": '<resources>\n    <string name="a">A</string>\n    </resources>\n',
+    "products": '<resources>\n    <string name="a" product="tablet">T</string>\n'
+    '    <string name="b" product="tablet">T</string>\n'
+    '    <string name="b" product="default">D</string>\n</resources>\n',
+    "untranslatable_last": '<resources>\n    <string name="a">A</string>\n'
+    '    <string name="t" translatable="false">T</string>\n  </resources>\n',
+    "namespaces": f'<resources {_XLIFF}>\n    <string name="a">A <xliff:g id="x">%s'
+    "</xliff:g></string>\n</resources>\n",
+    "cdata": '<resources>\n    <string name="a"><![CDATA[<b>A</b>]]></string>\n'
+    "</resources>",
+    "empty": '<resources>\n    <string name="t" translatable="false">T</string>\n'
+    "</resources>\n",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks for crowdin_sync.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    importtime = subparsers.add_parser(
+        "importtime", help="Check the import time of the CLI against a budget"
+    )
+    importtime.add_argument(
+        "--budget-ms",
+        type=float,
+        default=60,
+        help="Maximum cumulative import time per scenario (default: 60ms)",
+    )
+    importtime.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="Number of runs, the fastest one is compared to the budget",
+    )
+
+    record = subparsers.add_parser(
+        "record", help="Record the artifacts of a run for replaying it"
+    )
+    record.add_argument("-b", "--branch", required=True, help="LineageOS branch")
+    record.add_argument("-o", "--output", required=True, help="Recording directory")
+    record.add_argument("--zip", nargs="+", default=[], help="Downloaded zips")
+    record.add_argument(
+        "--crowdin-output",
+        nargs="+",
+        default=[],
+        help="Saved stdout of 'crowdin download', its files are taken from the tree",
+    )
+
+    replay = subparsers.add_parser(
+        "replay", help="Replay a recording against local repos and check the baseline"
+    )
+    replay.add_argument("recording", help="Recording directory")
+    replay.add_argument(
+        "--baseline", help="Baseline file (default: baseline.json in the recording)"
+    )
+    replay.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Maximum allowed regression of each metric (default: 0.1 = 10%%)",
+    )
+    replay.add_argument(
+        "--update-baseline", action="store_true", help="Store the result as baseline"
+    )
+    replay.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="Number of runs, the best result of each metric is used",
+    )
+    replay.add_argument("--worktree-free", action="store_true")
+    replay.add_argument("-j", "--jobs", type=int, default=8)
+    replay.add_argument(
+        "--keep", action="store_true", help="Keep the directories of the runs"
+    )
+
+    cleancheck = subparsers.add_parser(
+        "cleancheck",
+        help="Check that translation files are cleaned like the previous cleaner did",
+    )
+    cleancheck.add_argument(
+        "paths",
+        nargs="*",
+        help="Files or directories with files to check, next to the built-in cases",
+    )
+
+    # Used by replay to run the pipeline in a separate process
+    worker = subparsers.add_parser("replay-worker")
+    worker.add_argument("recording")
+    worker.add_argument("work_dir")
+    worker.add_argument("--worktree-free", action="store_true")
+    worker.add_argument("-j", "--jobs", type=int, default=8)
+    return parser.parse_args()
+
+
+# ################################ IMPORTTIME ################################ #
+
+
+def measure_imports(modules):
+    code = "import " + ", ".join(modules)
+    cmd = [sys.executable, "-X", "importtime", "-c", code]
+    p = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=_DIR, universal_newlines=True)
+    comm = p.communicate()
+    if p.returncode != 0:
+        print(f"Failed to import {modules}:\n{comm[1]}", file=sys.stderr)
+        sys.exit(1)
+
+    # Each line looks like "import time: self [us] | cumulative | imported package",
+    # the package is indented according to its nesting level
+    total = 0
+    imported = []
+    for line in comm[1].split("\n"):
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:") :].split("|")
+        imported.append(name.strip())
+        if name[1:] in modules:
+            total += int(cumulative)
+    return total / 1000, imported
+
+
+def check_importtime(budget_ms, runs):
+    failed = False
+    for scenario, modules in _IMPORT_SCENARIOS.items():
+        results = [measure_imports(modules) for _ in range(runs)]
+        duration = min(r[0] for r in results)
+        imported = results[0][1]
+
+        heavy = [m for m in imported if m in _HEAVY_MODULES]
+        status = "OK"
+        if duration > budget_ms or heavy:
+            status = "FAILED"
+            failed = True
+        print(f"{scenario}: {duration:.1f}ms (budget {budget_ms:.0f}ms) - {status}")
+        if heavy:
+            print(f"  imports heavy dependencies: {', '.join(heavy)}")
+    return not failed
+
+
+# ################################## RECORD ################################## #
+
+
+def record(branch, output, zip_files, crowdin_outputs):
+    import download
+    import utils
+
+    # git archive runs in the projects, so it needs the absolute path
+    output = os.path.abspath(output)
+    base_path = utils.get_base_path(branch)
+    recording = {
+        "branch": branch,
+        "manifests": [],
+        "zips": [],
+        "crowdin_outputs": [],
+        "projects": [],
+    }
+    os.makedirs(output, exist_ok=True)
+
+    manifests = [
+        f"{base_path}/android/default.xml",
+        f"{base_path}/android/snippets/lineage.xml",
+        f"{_DIR}/config/{branch}_extra_packages.xml",
+    ]
+    for i, manifest in enumerate(manifests):
+        if os.path.isfile(manifest):
+            name = f"manifest_{i}.xml"
+            shutil.copy(manifest, os.path.join(output, name))
+            recording["manifests"].append(name)
+
+    extracted = []
+    for i, zip_file in enumerate(zip_files):
+        name = f"download_{i}.zip"
+        shutil.copy(zip_file, os.path.join(output, name))
+        recording["zips"].append(name)
+        extracted += get_zip_files(zip_file, branch)
+
+    # The crowdin CLI writes to the tree, so keep a copy of the files it extracted
+    for i, crowdin_output in enumerate(crowdin_outputs):
+        name = f"crowdin_{i}.txt"
+        shutil.copy(crowdin_output, os.path.join(output, name))
+        recording["crowdin_outputs"].append(name)
+        with open(crowdin_output, "r") as fh:
+            files = download.get_extracted_files(fh.read(), branch)
+        for f in files:
+            src = os.path.join(base_path, f.strip("/"))
+            if os.path.isfile(src):
+                dest = os.path.join(output, "files", f.strip("/"))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy(src, dest)
+        extracted += files
+
+    # Snapshot the checked out trees of all projects with translations
+    xml = [utils.load_xml(x=os.path.join(output, m)) for m in recording["manifests"]]
+    items = utils.get_projects(xml)
+    paths = set()
+    for f in extracted:
+        project = utils.find_project(items, f.strip("/"))
+        if project is not None:
+            paths.add(project.get("path"))
+    for path in sorted(paths):
+        project = utils.find_project(items, path)
+        print(f"Recording {path}")
+        archive = os.path.join(output, "repos", f"{path}.tar.gz")
+        os.makedirs(os.path.dirname(archive), exist_ok=True)
+        run(
+            [
+                "git",
+                "-C",
+                os.path.join(base_path, path),
+                "archive",
+                "-o",
+                archive,
+                "HEAD",
+            ]
+        )
+        recording["projects"].append(
+            {
+                "path": path,
+                "name": project.get("name"),
+                "branch": project.get("revision") or branch,
+            }
+        )
+
+    with open(os.path.join(output, "recording.json"), "w") as fh:
+        json.dump(recording, fh, indent=2)
+    print(f"Recorded {len(extracted)} files of {len(paths)} projects to {output}")
+
+
+def get_zip_files(zip_file, branch):
+    import zipfile
+
+    with zipfile.ZipFile(zip_file, "r") as z:
+        return [
+            n.split("/", 1)[1]
+            for n in z.namelist()
+            if n.startswith(branch) and n.endswith(".xml")
+        ]
+
+
+def run(cmd, cwd=None):
+    p = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=cwd, universal_newlines=True)
+    comm = p.communicate()
+    if p.returncode != 0:
+        print(f"Failed to run {' '.join(cmd)}:\n{comm[1]}", file=sys.stderr)
+        sys.exit(1)
+    return comm[0]
+
+
+# ################################## REPLAY ################################## #
+
+
+def check_replay(
+    recording_dir, baseline, threshold, update, runs, worktree_free, jobs, keep
+):
+    with open(os.path.join(recording_dir, "recording.json"), "r") as fh:
+        recording = json.load(fh)
+    baseline = baseline or os.path.join(recording_dir, "baseline.json")
+
+    results = []
+    for i in range(runs):
+        work_dir = tempfile.mkdtemp(prefix="crowdin_replay_")
+        prepare_replay(recording_dir, recording, work_dir)
+        result = run_replay(recording_dir, work_dir, worktree_free, jobs)
+        print(
+            f"Run {i + 1}/{runs}: {result['time']:.2f}s, {result['peak_rss_mb']:.1f}MB, "
+            f"{result['subprocesses']} subprocesses"
+        )
+        results.append(result)
+        if keep:
+            print(f"  kept {work_dir}")
+        else:
+            shutil.rmtree(work_dir)
+    best = {m: min(r[m] for r in results) for m in _REPLAY_METRICS}
+
+    if update or not os.path.isfile(baseline):
+        with open(baseline, "w") as fh:
+            json.dump(best, fh, indent=2)
+        print(f"Stored the baseline in {baseline}")
+        return True
+
+    with open(baseline, "r") as fh:
+        previous = json.load(fh)
+    failed = False
+    for metric, (label, fmt) in _REPLAY_METRICS.items():
+        value = best[metric]
+        base = previous.get(metric)
+        if base is None:
+            print(f"{label}: {fmt.format(value)} (no baseline)")
+            continue
+        change = (value - base) / base if base > 0 else 0
+        status = "OK"
+        if change > threshold:
+            status = "FAILED"
+            failed = True
+        print(
+            f"{label}: {fmt.format(value)} (baseline {fmt.format(base)}, "
+            f"{change:+.1%}) - {status}"
+        )
+    return not failed
+
+
+def prepare_replay(recording_dir, recording, work_dir):
+    # Every project gets a checkout in the base path and a bare repo acting as gerrit
+    base_path = os.path.join(work_dir, "base")
+    remotes = os.path.join(work_dir, "remotes")
+    for project in recording["projects"]:
+        tree = os.path.join(base_path, project["path"])
+        os.makedirs(tree, exist_ok=True)
+        archive = os.path.join(recording_dir, "repos", f"{project['path']}.tar.gz")
+        with tarfile.open(archive, "r:gz") as tar:
+            tar.extractall(tree)
+
+        remote = os.path.join(remotes, project["name"])
+        run(["git", "init", "-q", "--bare", remote])
+        run(["git", "init", "-q"], cwd=tree)
+        run(["git", "add", "-A"], cwd=tree)
+        run(
+            [
+                "git",
+                "-c",
+                "user.name=bench",
+                "-c",
+                "user.email=bench@localhost",
+                "commit",
+                "-q",
+                "-m",
+                "Snapshot",
+            ],
+            cwd=tree,
+        )
+        run(
+            ["git", "push", "-q", remote, f"HEAD:refs/heads/{project['branch']}"],
+            cwd=tree,
+        )
+        run(["git", "checkout", "-q", "--detach"], cwd=tree)
+
+    # The pushes to gerrit end up in the bare repos
+    with open(os.path.join(work_dir, "gitconfig"), "w") as fh:
+        fh.write(
+            f"[user]\n\tname = bench\n\temail = bench@localhost\n"
+            f'[url "file://{remotes}/"]\n'
+            f"\tinsteadOf = ssh://{_USERNAME}@review.lineageos.org:29418/\n"
+        )
+
+    # Count the git processes, also the ones started by GitPython
+    shim_dir = os.path.join(work_dir, "shim")
+    os.makedirs(shim_dir)
+    shim = os.path.join(shim_dir, "git")
+    with open(shim, "w") as fh:
+        fh.write(
+            f'#!/bin/sh\necho >> "$BENCH_GIT_LOG"\nexec {shutil.which("git")} "$@"\n'
+        )
+    os.chmod(shim, 0o755)
+
+
+def run_replay(recording_dir, work_dir, worktree_free, jobs):
+    git_log = os.path.join(work_dir, "git.log")
+    open(git_log, "w").close()
+    env = dict(
+        os.environ,
+        PATH=f"{os.path.join(work_dir, 'shim')}{os.pathsep}{os.environ['PATH']}",
+        GIT_CONFIG_GLOBAL=os.path.join(work_dir, "gitconfig"),
+        GIT_CONFIG_NOSYSTEM="1",
+        LINEAGE_CROWDIN_STATE_DIR=os.path.join(work_dir, "state"),
+        # Don't wait for gerrit's open changes, the pushes only reach the bare repos
+        LINEAGE_GERRIT_QUERY_CMD="true",
+        BENCH_GIT_LOG=git_log,
+    )
+    cmd = [sys.executable, os.path.realpath(__file__), "replay-worker"]
+    cmd += [recording_dir, work_dir, f"--jobs={jobs}"]
+    if worktree_free:
+        cmd.append("--worktree-free")
+    with open(os.path.join(work_dir, "replay.log"), "w") as log:
+        p = Popen(cmd, stdout=log, stderr=log, stdin=DEVNULL, cwd=_DIR, env=env)
+        p.wait()
+    if p.returncode != 0:
+        print(f"Replay failed, see {work_dir}/replay.log", file=sys.stderr)
+        sys.exit(1)
+
+    with open(os.path.join(work_dir, "result.json"), "r") as fh:
+        result = json.load(fh)
+    with open(git_log, "r") as fh:
+        result["subprocesses"] = len(fh.readlines())
+    return result
+
+
+def replay_worker(recording_dir, work_dir, worktree_free, jobs):
+    import download
+    import from_zip
+    import utils
+
+    with open(os.path.join(recording_dir, "recording.json"), "r") as fh:
+        recording = json.load(fh)
+    branch = recording["branch"]
+    base_path = os.path.join(work_dir, "base")
+    xml = [
+        utils.load_xml(x=os.path.join(recording_dir, m)) for m in recording["manifests"]
+    ]
+
+    duration = 0
+    for name in recording["crowdin_outputs"]:
+        # Put the files in place like the crowdin CLI does
+        files_dir = os.path.join(recording_dir, "files")
+        if os.path.isdir(files_dir):
+            shutil.copytree(files_dir, base_path, dirs_exist_ok=True)
+        with open(os.path.join(recording_dir, name), "r") as fh:
+            extracted = download.get_extracted_files(fh.read(), branch)
+        start = time.monotonic()
+        download.upload_translations_gerrit(
+            extracted, xml, base_path, branch, _USERNAME, worktree_free, None, jobs
+        )
+        duration += time.monotonic() - start
+
+    if len(recording["zips"]) > 0:
+        zips = [os.path.join(recording_dir, z) for z in recording["zips"]]
+        start = time.monotonic()
+        from_zip.unzip(
+            zips, base_path, branch, xml, _USERNAME, worktree_free, None, jobs
+        )
+        duration += time.monotonic() - start
+
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss /= 1024 * 1024 if sys.platform == "darwin" else 1024
+    with open(os.path.join(work_dir, "result.json"), "w") as fh:
+        json.dump({"time": duration, "peak_rss_mb": peak_rss}, fh)
+
+
+# ################################ CLEANCHECK ################################ #
+
+
+def check_clean(paths):
+    import difflib
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files += [os.path.join(root, n) for n in names if n.endswith(".xml")]
+        else:
+            files.append(path)
+
+    differ = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Every case with and without the declaration and license header
+        for name, content in _CLEAN_CASES.items():
+            for prefix, suffix in [("", ""), (_DECLARATION + _LICENSE, "_header")]:
+                path = os.path.join(tmp_dir, f"{name}{suffix}.xml")
+                with open(path, "w") as fh:
+                    fh.write(prefix + content)
+                files.append(path)
+
+        for i, path in enumerate(sorted(files)):
+            expected = reference_clean(path)
+            actual = clean(path, os.path.join(tmp_dir, "out", f"{i}.xml"))
+            if actual == expected:
+                continue
+            differ += 1
+            print(f"{path} is cleaned differently:")
+            if actual is None or expected is None:
+                print(f"  expected {expected!r}, got {actual!r}")
+                continue
+            diff = difflib.unified_diff(
+                expected.splitlines(True), actual.splitlines(True), "before", "now"
+            )
+            sys.stdout.writelines(diff)
+
+    print(f"Checked {len(files)} files, {differ} cleaned differently")
+    return differ == 0
+
+
+def clean(path, dest):
+    # The cleaned content, None if the file is removed, "malformed" if it can't be parsed
+    import contextlib
+    import io
+
+    import download
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = download.clean_xml_file(path, None, dest)
+    if result != "cleaned":
+        return None if result == "removed" else result
+    with open(dest, "r") as fh:
+        return fh.read()
+
+
+def reference_clean(path):
+    # The cleaner before it was streamed, which parsed the whole file with lxml
+    import re
+
+    from lxml import etree
+
+    with open(path, "r") as fh:
+        declaration = fh.readline().rstrip("\n")
+    try:
+        tree = etree.parse(path, etree.XMLParser(strip_cdata=False)).getroot()
+    except etree.XMLSyntaxError:
+        return "malformed"
+
+    # Strings with a product but without product=default
+    names = {s.get("name") for s in tree.xpath("//string[@product]")}
+    for name in names:
+        strings = tree.xpath(f"//string[@name='{name}']")
+        if not any(s.get("product") in (None, "default") for s in strings):
+            for string in strings:
+                tree.remove(string)
+
+    header = ""
+    for c in tree.xpath("//comment()"):
+        if c.getparent() is None:
+            header += str(c).replace("\\n", "\n").replace("\\t", "\t") + "\n"
+        else:
+            c.getparent().remove(c)
+    for n in tree.xpath('/resources/*[@translatable="false"]'):
+        tree.remove(n)
+
+    content = ""
+    if "<?" in declaration:
+        content = declaration + "\n"
+    content += etree.tostring(tree, pretty_print=True, encoding="unicode")
+    if header != "":
+        content = content.replace("?>\n", "?>\n" + header)
+    content = re.sub(r"[ ]*</resources>", r"</resources>", content)
+    return None if len(tree) == 0 else content
+
+
+# ################################### MAIN ################################### #
+
+
+def main():
+    args = parse_args()
+    if args.command == "importtime":
+        if not check_importtime(args.budget_ms, args.runs):
+            sys.exit(1)
+    elif args.command == "record":
+        record(args.branch, args.output, args.zip, args.crowdin_output)
+    elif args.command == "replay":
+        if not check_replay(
+            args.recording,
+            args.baseline,
+            args.threshold,
+            args.update_baseline,
+            args.runs,
+            args.worktree_free,
+            args.jobs,
+            args.keep,
+        ):
+            sys.exit(1)
+    elif args.command == "cleancheck":
+        if not check_clean(args.paths):
+            sys.exit(1)
+    elif args.command == "replay-worker":
+        replay_worker(args.recording, args.work_dir, args.worktree_free, args.jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# change_index.py
+#
+# Helper script for keeping an index of the open translation changes on
+# LineageOS' gerrit, bootstrapped by one query and kept current by stream-events
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import json
+import os
+import shlex
+import sys
+import threading
+
+from subprocess import Popen, PIPE
+
+import metrics
+import utils
+
+_MESSAGE = "Automatic translation import"
+_TOPIC = "translation"
+_EVENTS = [
+    "patchset-created",
+    "change-abandoned",
+    "change-deleted",
+    "change-merged",
+    "change-restored",
+    "topic-changed",
+]
+
+# The open changes by number, None while the index isn't running. The stream is
+# only read while holding the lock, so events arriving during the bootstrap wait
+# in the pipe and are applied afterwards, in order.
+_LOCK = threading.Lock()
+_CHANGES = None
+_THREAD = None
+_PROCESS = None
+
+
+def enable(username):
+    # Starts the index, unless it's already running. Returns whether it is available.
+    global _CHANGES, _THREAD, _PROCESS
+    with _LOCK:
+        if _THREAD is not None and _THREAD.is_alive():
+            return True
+
+        print("Starting the index of open translation changes")
+        # Can be replaced by a local stand-in for testing
+        cmd = os.getenv("LINEAGE_GERRIT_EVENTS_CMD")
+        if cmd is not None:
+            cmd = shlex.split(cmd)
+        else:
+            cmd = utils.get_gerrit_base_cmd(username) + ["stream-events"]
+            for event in _EVENTS:
+                cmd += ["-s", event]
+        try:
+            _PROCESS = Popen(cmd, stdout=PIPE, universal_newlines=True)
+        except OSError as e:
+            print(e, "Failed to stream gerrit events", file=sys.stderr)
+            return False
+        atexit.register(_PROCESS.terminate)
+        _THREAD = threading.Thread(target=read_events, args=(_PROCESS,), daemon=True)
+        _THREAD.start()
+
+        changes = query_changes(username)
+        if changes is None:
+            _PROCESS.terminate()
+            return False
+        _CHANGES = changes
+    print(f"Found {len(changes)} open translation changes")
+    return True
+
+
+def query_changes(username):
+    # Gerrit limits the number of results, so continue where the last page ended
+    changes = {}
+    start = 0
+    while True:
+        cmd = get_query_cmd(username) + [
+            "status:open",
+            f'message:"{_MESSAGE}"',
+            f"topic:{_TOPIC}",
+            "--current-patch-set",
+            "--format=JSON",
+            "--start",
+            str(start),
+        ]
+        msg, code = utils.run_subprocess(cmd)
+        if code != 0:
+            metrics.add("crowdin_sync_errors", service="gerrit")
+            print(f"Failed to query open changes: {msg[1]}", file=sys.stderr)
+            return None
+
+        more = False
+        for line in msg[0].strip("\n").split("\n"):
+            if line == "":
+                continue
+            js = json.loads(line)
+            if js.get("type") == "stats":
+                start += js["rowCount"]
+                more = js.get("moreChanges", False)
+            elif "currentPatchSet" in js:
+                changes[js["number"]] = get_change(js, js["currentPatchSet"])
+        if not more:
+            return changes
+
+
+def get_query_cmd(username):
+    # Can be replaced by a local stand-in for testing, which gets the query
+    # arguments appended. No output means no open changes.
+    cmd = os.getenv("LINEAGE_GERRIT_QUERY_CMD")
+    if cmd is not None:
+        return shlex.split(cmd)
+    return utils.get_gerrit_base_cmd(username) + ["query"]
+
+
+def read_events(process):
+    global _CHANGES
+    for line in process.stdout:
+        with _LOCK:
+            if _CHANGES is None:
+                continue
+            try:
+                apply_event(json.loads(line))
+            except (ValueError, KeyError) as e:
+                print(e, f"Failed to read gerrit event:\n{line}", file=sys.stderr)
+
+    # Without events the index would get outdated, so fall back to queries
+    with _LOCK:
+        _CHANGES = None
+    process.wait()
+    print("Gerrit event stream ended, stopping the index", file=sys.stderr)
+
+
+def apply_event(event):
+    change = event.get("change")
+    if change is None:
+        return
+    number = change["number"]
+    if event["type"] in ("patchset-created", "change-restored"):
+        if is_translation(change):
+            _CHANGES[number] = get_change(change, event["patchSet"])
+    elif event["type"] == "topic-changed":
+        # The event doesn't tell the current patch set, so changes which get the
+        # topic are only picked up with their next patch set
+        if not is_translation(change):
+            _CHANGES.pop(number, None)
+    else:
+        _CHANGES.pop(number, None)
+
+
+def is_translation(change):
+    return (
+        change.get("topic") == _TOPIC
+        and change.get("status", "NEW") == "NEW"
+        and _MESSAGE in change.get("commitMessage", _MESSAGE)
+    )
+
+
+def get_change(change, patch_set):
+    return {
+        "number": change["number"],
+        "project": change["project"],
+        "branch": change["branch"],
+        "url": change["url"],
+        "owner": change.get("owner", {}),
+        "uploader": patch_set.get("uploader", {}),
+        "revision": patch_set["revision"],
+        "patch_set": patch_set["number"],
+    }
+
+
+def get_size():
+    with _LOCK:
+        return None if _CHANGES is None else len(_CHANGES)
+
+
+def get_open_changes(branches, owner=None, uploader=None):
+    # Like gerrit.get_open_changes(), None if the index isn't available
+    with _LOCK:
+        if _CHANGES is None:
+            return None
+        return {
+            c["revision"]: c["url"]
+            for c in _CHANGES.values()
+            if c["branch"] in branches
+            and matches(c["owner"], owner)
+            and matches(c["uploader"], uploader)
+        }
+
+
+def get_changes(username):
+    # All open changes, from the index or, if it isn't running, from a query
+    with _LOCK:
+        if _CHANGES is not None:
+            return [dict(c) for c in _CHANGES.values()]
+    changes = query_changes(username)
+    return [] if changes is None else list(changes.values())
+
+
+def discard(revision):
+    # Changes we abandoned or submitted, before their event arrives
+    with _LOCK:
+        if _CHANGES is None:
+            return
+        for number, change in list(_CHANGES.items()):
+            if change["revision"] == revision:
+                del _CHANGES[number]
+
+
+def matches(account, value):
+    # Like the owner: and uploader: operators, match the username, email or name
+    if value is None:
+        return True
+    return value.lower() in [str(v).lower() for v in account.values()]
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# crowdin_api.py
+#
+# Helper script for talking to the Crowdin API v2 directly,
+# without starting the crowdin CLI
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import requests
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import progress
+import timeline
+import utils
+
+# Can be pointed to a local stand-in of the API for testing
+crowdin_url = os.getenv(
+    "LINEAGE_CROWDIN_API_URL", "https://api.crowdin.com/api/v2"
+).rstrip("/")
+
+_BUILD_POLL_INTERVAL = 2
+_PAGE_SIZE = 500
+_BUILD_TIMEOUT = 30 * 60
+_LOCK = threading.Lock()
+_SESSION = None
+
+
+def get_session():
+    # One session for all requests of a run, so connections are reused
+    global _SESSION
+    with _LOCK:
+        if _SESSION is None:
+            token = get_access_token()
+            retries = Retry(
+                total=5,
+                backoff_factor=1,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+            )
+            adapter = HTTPAdapter(pool_maxsize=16, max_retries=retries)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(
+                {
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {token}",
+                }
+            )
+            _SESSION = session
+    return _SESSION
+
+
+def get_access_token():
+    token = os.getenv("LINEAGE_CROWDIN_API_TOKEN")
+    if token is None:
+        raise RuntimeError(
+            "Could not determine api token, please export LINEAGE_CROWDIN_API_TOKEN "
+            "to the environment!"
+        )
+    return token
+
+
+def get(path, params=None):
+    with timeline.span(f"GET {path}", "crowdin"):
+        resp = get_session().get(f"{crowdin_url}{path}", params=params)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def get_all(path, params=None):
+    # Follows the pagination of list endpoints
+    items = []
+    params = dict(params or {}, limit=_PAGE_SIZE, offset=0)
+    while True:
+        page = get(path, params)["data"]
+        items += page
+        if len(page) < _PAGE_SIZE:
+            return items
+        params["offset"] += _PAGE_SIZE
+
+
+def post(path, data):
+    with timeline.span(f"POST {path}", "crowdin"):
+        resp = get_session().post(f"{crowdin_url}{path}", json=data)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def get_branch_id(project_id, branch):
+    branches = get(f"/projects/{project_id}/branches", {"name": branch})
+    for b in branches["data"]:
+        if b["data"]["name"] == branch:
+            return b["data"]["id"]
+    raise RuntimeError(f"Branch {branch} not found in project {project_id}")
+
+
+def get_target_languages(project_id):
+    return get(f"/projects/{project_id}")["data"]["targetLanguageIds"]
+
+
+def build_translations(project_id, branch_id, languages=None):
+    data = {"branchId": branch_id}
+    if languages is not None:
+        data["targetLanguageIds"] = languages
+    build = post(f"/projects/{project_id}/translations/builds", data)
+    return build["data"]["id"]
+
+
+def wait_for_build(project_id, build_id):
+    deadline = time.monotonic() + _BUILD_TIMEOUT
+    while True:
+        build = get(f"/projects/{project_id}/translations/builds/{build_id}")
+        status = build["data"]["status"]
+        if status == "finished":
+            return
+        if status in ("failed", "canceled"):
+            raise RuntimeError(f"Build {build_id} of project {project_id} {status}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Build {build_id} of project {project_id} timed out")
+        time.sleep(_BUILD_POLL_INTERVAL)
+
+
+def download_build(project_id, build_id, dest):
+    link = get(f"/projects/{project_id}/translations/builds/{build_id}/download")
+    # The link is pre-signed, so don't send our token along
+    with timeline.span("download build", "crowdin"), get_session().get(
+        link["data"]["url"], headers={"Authorization": None}, stream=True
+    ) as resp:
+        resp.raise_for_status()
+        with open(dest, "wb") as fh:
+            for chunk in resp.iter_content(chunk_size=1 << 16):
+                fh.write(chunk)
+
+
+def download_translations(
+    config_dict, branch, dest_dir, incremental=False, selected_languages=None
+):
+    # Build and download the translations of all configs, returns the paths of the zips
+    # with the files to extract from them (None for all) and the new progress. The files
+    # are given by their paths in the zip, with the project, language and source of each.
+    zips = {}
+    translation_progress = load_progress(branch)
+    for i, cfg in enumerate(config_dict["files"]):
+        print(
+            f"\nDownloading translations from the Crowdin API "
+            f"({config_dict['headers'][i]})"
+        )
+        project_id = utils.load_config(cfg)["project_id"]
+        branch_id = get_branch_id(project_id, branch)
+        languages = None
+        files = None
+        if incremental:
+            old = translation_progress.get(str(project_id))
+            new, languages, changed = get_changed(project_id, branch_id, branch, old)
+            translation_progress[str(project_id)] = new
+            if languages is not None and len(languages) == 0:
+                print("No translation progress since the last run")
+                continue
+            if languages is not None:
+                print(
+                    f"Progress changed for {len(changed)} translations in: "
+                    f"{', '.join(languages)}"
+                )
+                files = get_translation_paths(
+                    cfg, project_id, changed, get_android_codes(project_id)
+                )
+        if selected_languages is not None:
+            targets = languages or get_target_languages(project_id)
+            languages = [lang for lang in targets if lang in selected_languages]
+            if len(languages) == 0:
+                print("None of the selected languages are translated in this project")
+                continue
+        build_id = build_translations(project_id, branch_id, languages)
+        stage = f"{branch} crowdin build"
+        progress.start(stage)
+        try:
+            wait_for_build(project_id, build_id)
+            dest = os.path.join(dest_dir, f"{project_id}.zip")
+            download_build(project_id, build_id, dest)
+        finally:
+            progress.finish(stage)
+        zips[dest] = files
+    return zips, translation_progress
+
+
+# ################################# PROGRESS ################################# #
+
+
+def get_changed(project_id, branch_id, branch, old):
+    # Compares the translation progress to the one of the last run, returns the new
+    # progress and the changed languages and files, None meaning all of them
+    new = {
+        "updated": int(time.time()),
+        "languages": get_language_progress(project_id, branch_id),
+        "files": {},
+    }
+    if old is None:
+        old = {"languages": {}, "files": {}}
+    languages = [
+        lang
+        for lang, counters in new["languages"].items()
+        if old["languages"].get(lang) != counters
+    ]
+    for lang in new["languages"]:
+        if lang not in languages and lang in old["files"]:
+            new["files"][lang] = old["files"][lang]
+
+    # The changed translations, as language and source path
+    changed = set()
+    if len(languages) > 0:
+        file_paths = get_file_paths(project_id, branch_id, branch)
+        for lang in languages:
+            new["files"][lang] = get_file_progress(project_id, lang, file_paths)
+            old_files = old["files"].get(lang, {})
+            changed |= {
+                (lang, path)
+                for path, counters in new["files"][lang].items()
+                if old_files.get(path) != counters
+            }
+
+    # Without a previous run everything has to be downloaded
+    if len(old["languages"]) == 0:
+        return new, None, None
+    return new, languages, sorted(changed)
+
+
+def get_language_progress(project_id, branch_id):
+    result = {}
+    path = f"/projects/{project_id}/branches/{branch_id}/languages/progress"
+    for lang in get_all(path):
+        result[lang["data"]["languageId"]] = get_counters(lang["data"])
+    return result
+
+
+def get_file_progress(project_id, language, file_paths):
+    result = {}
+    for f in get_all(f"/projects/{project_id}/languages/{language}/progress"):
+        path = file_paths.get(f["data"]["fileId"])
+        if path is not None:
+            result[path] = get_counters(f["data"])
+    return result
+
+
+def get_file_paths(project_id, branch_id, branch):
+    # The paths of the source files in the branch, relative to the base path
+    paths = {}
+    for f in get_all(f"/projects/{project_id}/files", {"branchId": branch_id}):
+        path = f["data"]["path"].lstrip("/")
+        if path.startswith(f"{branch}/"):
+            path = path[len(branch) + 1 :]
+        paths[f["data"]["id"]] = path
+    return paths
+
+
+def get_counters(data):
+    return [
+        data["words"]["translated"],
+        data["words"]["approved"],
+        data["phrases"]["translated"],
+        data["phrases"]["approved"],
+    ]
+
+
+def get_android_codes(project_id):
+    # The %android_code% of the target languages, the mapping of the project comes first
+    project = get(f"/projects/{project_id}")["data"]
+    mapping = project.get("languageMapping") or {}
+    return {
+        lang["id"]: mapping.get(lang["id"], {}).get("android_code", lang["androidCode"])
+        for lang in project["targetLanguages"]
+    }
+
+
+def get_translation_paths(cfg, project_id, changed, android_codes):
+    # The changed translations are exported by the translation patterns of the config,
+    # which may put them somewhere else entirely (e.g. overlays in vendor/crowdin)
+    sources = {}
+    for lang, source in changed:
+        sources.setdefault(source, []).append(lang)
+
+    paths = {}
+    for f in utils.load_config(cfg)["files"]:
+        source = f["source"].strip("/")
+        mapping = f.get("languages_mapping", {}).get("android_code", {})
+        for lang in sources.get(source, []):
+            android_code = mapping.get(lang, android_codes.get(lang, lang))
+            path = (
+                f["translation"]
+                .strip("/")
+                .replace("%android_code%", android_code)
+                .replace("%original_file_name%", os.path.basename(source))
+            )
+            paths[path] = (str(project_id), lang, source)
+    return paths
+
+
+def load_progress(branch):
+    return utils.load_state(f"{branch}_progress")
+
+
+def save_progress(branch, translation_progress, missing=()):
+    # Changed translations which weren't downloaded keep their old progress, along with
+    # their language, so they are downloaded again next time
+    old = load_progress(branch)
+    for project_id, lang, source in missing:
+        new = translation_progress[project_id]
+        old_project = old.get(project_id, {"languages": {}, "files": {}})
+        if lang in old_project["languages"]:
+            new["languages"][lang] = old_project["languages"][lang]
+        else:
+            new["languages"].pop(lang, None)
+        old_files = old_project["files"].get(lang, {})
+        if source in old_files:
+            new["files"][lang][source] = old_files[source]
+        else:
+            new["files"][lang].pop(source, None)
+    utils.save_state(f"{branch}_progress", translation_progress)
@@ -23,30 +23,37 @@
 import argparse
 import os
 import sys
+import time
 
 from signal import signal, SIGINT
 
-import download
-import from_zip
-import gerrit
-import upload
+# Only import the light-weight modules here, the others pull in GitPython, lxml or requests
+# and are imported where they are needed, so e.g. the gerrit commands start quickly
+import journal
+import metrics
+import timeline
 import utils
-import wiki
 
 _DIR = os.path.dirname(os.path.realpath(__file__))
 _COMMITS_CREATED = False
-_DONE = False
 
 
 # ############################################################################ #
 
 
-def parse_args():
+def parse_args(argv=None, allow_abbrev=True):
     parser = argparse.ArgumentParser(
-        description="Synchronising LineageOS' translations with Crowdin"
+        description="Synchronising LineageOS' translations with Crowdin",
+        allow_abbrev=allow_abbrev,
     )
     parser.add_argument("-u", "--username", help="Gerrit username")
-    parser.add_argument("-b", "--branch", help="LineageOS branch", required=True)
+    parser.add_argument(
+        "-b",
+        "--branch",
+        nargs="+",
+        help="LineageOS branch(es), multiple branches are synced concurrently",
+        required=True,
+    )
     parser.add_argument("-c", "--config", help="Custom yaml config")
     parser.add_argument(
         "--upload-sources", action="store_true", help="Upload sources to Crowdin"
@@ -56,9 +63,32 @@ def parse_args():
         action="store_true",
         help="Upload translations to Crowdin",
     )
+    parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        help="Only upload translations changed since the last upload",
+    )
     parser.add_argument(
         "--download", action="store_true", help="Download translations from Crowdin"
     )
+    parser.add_argument(
+        "--crowdin-api",
+        action="store_true",
+        help="Download through the Crowdin API instead of the CLI, which stays the fallback",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only download the languages and files whose Crowdin progress changed "
+        "since the last run (uses the Crowdin API)",
+    )
+    parser.add_argument(
+        "--download-splits",
+        type=int,
+        default=1,
+        help="Split each crowdin config into this many balanced parts, which are "
+        "downloaded in parallel (default: 1)",
+    )
     parser.add_argument(
         "-g",
         "--gerrit",
@@ -83,56 +113,136 @@ def parse_args():
     parser.add_argument(
         "--unzip", nargs="+", help="Specify a translation zip to treat like a download"
     )
+    parser.add_argument(
+        "--worktree-free",
+        action="store_true",
+        help="Create the translation commits without touching the checked out trees",
+    )
+    parser.add_argument(
+        "--rebase",
+        action="store_true",
+        help="Fetch the target branches of the changed projects in parallel and create "
+        "the translation commits on top of them",
+    )
+    parser.add_argument(
+        "--shard",
+        type=utils.parse_shard,
+        help="Only commit and push the i-th of n stable partitions of the projects (i/n)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="Number of projects processed in parallel (default: 8)",
+    )
+    parser.add_argument(
+        "--languages",
+        nargs="+",
+        help="Only sync these languages (Crowdin language codes, e.g. de pt-BR)",
+    )
+    parser.add_argument(
+        "--projects",
+        nargs="+",
+        help="Only sync these projects (paths or names from the manifest)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted download or unzip, reusing its extracted files",
+    )
+    parser.add_argument(
+        "--change-index",
+        action="store_true",
+        help="Keep an index of the open translation changes, fed by gerrit stream-events, "
+        "instead of querying gerrit for them",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write Prometheus metrics of the run to this file (for the textfile collector)",
+    )
+    parser.add_argument(
+        "--trace-file",
+        help="Write a timeline of the run in the Chrome trace event format to this file",
+    )
     parser.add_argument(
         "-w",
         "--generate_wiki_list",
         action="store_true",
         help="Get the proofreader list for the wiki"
     )
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def sig_handler(signal_received, frame):
-    global _DONE
     print("")
+    # While committing, finish the current project so the run can be resumed
+    if journal.is_running() and not utils.is_interrupted():
+        print("SIGINT or CTRL-C detected. Stopping after the current project")
+        utils.set_interrupted()
+        return
     print("SIGINT or CTRL-C detected. Exiting gracefully")
-    _DONE = True
     exit(0)
 
 
-# ################################### MAIN ################################### #
-
-
-def main():
-    signal(SIGINT, sig_handler)
-    args = parse_args()
-    default_branch = args.branch
-
-    username = utils.get_username(args)
-    if args.gerrit == "abandon":
-        gerrit.abandon(default_branch, username, args.owner, args.uploader, args.message)
-        sys.exit(0)
-    elif args.gerrit == "submit":
-        gerrit.submit(default_branch, username, args.owner, args.uploader)
-        sys.exit(0)
-    elif args.gerrit == "vote":
-        gerrit.vote(default_branch, username, args.owner, args.uploader, args.message)
-        sys.exit(0)
+# ############################################################################ #
 
-    base_path = utils.get_base_path(default_branch)
-    config_dict = utils.get_config_dict(args.config, default_branch)
 
-    if args.path_to_crowdin == "crowdin" and not utils.check_dependencies():
-        sys.exit(1)
+def sync_branch(args, default_branch, base_path, config_dict, username):
+    import download
+    import from_zip
+    import upload
 
     if args.upload_sources:
-        upload.upload_sources_crowdin(default_branch, config_dict, args.path_to_crowdin)
+        upload.upload_sources_crowdin(
+            default_branch, config_dict, args.path_to_crowdin, base_path
+        )
     elif args.upload_translations:
+        xml_files = None
+        if args.changed_only:
+            xml_files = utils.get_xml_files(base_path, default_branch)
         upload.upload_translations_crowdin(
-            default_branch, config_dict, args.path_to_crowdin
+            default_branch,
+            config_dict,
+            args.path_to_crowdin,
+            base_path,
+            xml_files,
+            args.changed_only,
+        )
+    elif args.resume and journal.load(default_branch):
+        print(f"\nResuming interrupted run of {default_branch}")
+        xml_files = utils.get_xml_files(base_path, default_branch)
+        download.upload_translations_gerrit(
+            journal.get_extracted(default_branch),
+            xml_files,
+            base_path,
+            default_branch,
+            username,
+            args.worktree_free,
+            args.shard,
+            args.jobs,
+            args.rebase,
+            resume=True,
+            files_path=journal.get_files_path(default_branch),
         )
     elif args.download:
         xml_files = utils.get_xml_files(base_path, default_branch)
+        scope = utils.get_scope(args, xml_files)
+        use_api = args.crowdin_api or args.incremental
+        if use_api and download.download_crowdin_api(
+            base_path,
+            default_branch,
+            xml_files,
+            username,
+            config_dict,
+            args.worktree_free,
+            args.shard,
+            args.jobs,
+            args.incremental,
+            scope,
+            args.rebase,
+        ):
+            return
         download.download_crowdin(
             base_path,
             default_branch,
@@ -140,14 +250,122 @@ def main():
             username,
             config_dict,
             args.path_to_crowdin,
+            args.worktree_free,
+            args.shard,
+            args.jobs,
+            scope,
+            args.download_splits,
+            args.rebase,
         )
     elif args.unzip:
         xml_files = utils.get_xml_files(base_path, default_branch)
-        from_zip.unzip(args.unzip, base_path, default_branch, xml_files, username)
-    elif args.generate_wiki_list:
-        wiki.generate_wiki_list(config_dict["files"])
+        scope = utils.get_scope(args, xml_files)
+        from_zip.unzip(
+            args.unzip,
+            base_path,
+            default_branch,
+            xml_files,
+            username,
+            args.worktree_free,
+            args.shard,
+            args.jobs,
+            lambda zip_file, filename: utils.in_scope(scope, filename),
+            args.rebase,
+        )
+
+
+def run_gerrit(args, default_branch, username):
+    import gerrit
+
+    start = time.monotonic()
+    if args.gerrit == "abandon":
+        gerrit.abandon(
+            default_branch, username, args.owner, args.uploader, args.message
+        )
+    elif args.gerrit == "submit":
+        gerrit.submit(default_branch, username, args.owner, args.uploader)
+    elif args.gerrit == "vote":
+        gerrit.vote(default_branch, username, args.owner, args.uploader, args.message)
+    metrics.add_duration(default_branch, f"gerrit_{args.gerrit}", start)
 
-    if download.has_created_commits() or upload.has_uploaded():
+
+# ################################### MAIN ################################### #
+
+
+def main():
+    signal(SIGINT, sig_handler)
+    args = parse_args()
+    branches = args.branch
+
+    utils.enable_ssh_multiplexing()
+    if args.metrics_file:
+        metrics.enable(args.metrics_file)
+    if args.trace_file:
+        timeline.enable(args.trace_file)
+
+    username = utils.get_username(args)
+    if args.change_index:
+        import change_index
+
+        change_index.enable(username)
+    if args.gerrit:
+        for default_branch in branches:
+            run_gerrit(args, default_branch, username)
+        sys.exit(0)
+
+    base_paths = {}
+    config_dicts = {}
+    for default_branch in branches:
+        base_paths[default_branch] = utils.get_base_path(default_branch)
+        config_dicts[default_branch] = utils.get_config_dict(
+            args.config, default_branch
+        )
+
+    if args.path_to_crowdin == "crowdin" and not utils.check_dependencies():
+        sys.exit(1)
+
+    if args.generate_wiki_list:
+        import wiki
+
+        # The proofreaders are the same for all branches
+        wiki.generate_wiki_list(config_dicts[branches[0]]["files"])
+    elif len(branches) == 1:
+        default_branch = branches[0]
+        sync_branch(
+            args,
+            default_branch,
+            base_paths[default_branch],
+            config_dicts[default_branch],
+            username,
+        )
+    else:
+        import download
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Many of the translations are the same on all branches, so share the cleaning results
+        download.enable_clean_cache()
+        with ThreadPoolExecutor(max_workers=len(branches)) as executor:
+            futures = [
+                executor.submit(
+                    sync_branch,
+                    args,
+                    default_branch,
+                    base_paths[default_branch],
+                    config_dicts[default_branch],
+                    username,
+                )
+                for default_branch in branches
+            ]
+            for future in futures:
+                future.result()
+
+    import download
+    import upload
+
+    if utils.is_interrupted():
+        sys.exit(1)
+    elif download.has_created_commits() or upload.has_uploaded():
         print("\nDone!")
         sys.exit(0)
     else:
@@ -156,4 +374,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except SystemExit as e:
+        metrics.set_exit_code(e.code)
+        raise
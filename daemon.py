@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# daemon.py
+#
+# Runs crowdin_sync.py jobs received over HTTP in a long-running process,
+# so manifests, configs, repos and connections stay warm between them
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import itertools
+import json
+import sys
+import threading
+import time
+import traceback
+
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import change_index
+import crowdin_sync
+import metrics
+import utils
+
+# Options of crowdin_sync.py a job may set, by their names in the parsed arguments.
+# Everything else (e.g. the branch, config, crowdin executable or output files) is
+# up to whoever runs the daemon.
+_JOB_OPTIONS = [
+    "upload_sources",
+    "upload_translations",
+    "changed_only",
+    "download",
+    "crowdin_api",
+    "incremental",
+    "download_splits",
+    "gerrit",
+    "message",
+    "owner",
+    "uploader",
+    "worktree_free",
+    "rebase",
+    "shard",
+    "jobs",
+    "languages",
+    "projects",
+    "resume",
+    "change_index",
+]
+_MAX_FINISHED_JOBS = 100
+
+# Jobs are queued per branch, each branch has its own worker
+_LOCK = threading.Lock()
+_QUEUES = {}
+_WORKERS = {}
+_JOBS = OrderedDict()
+_IDS = itertools.count(1)
+_START = time.time()
+_USERNAME = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run crowdin_sync.py jobs received over HTTP"
+    )
+    parser.add_argument("-u", "--username", required=True, help="Gerrit username")
+    parser.add_argument(
+        "-l",
+        "--listen",
+        default="127.0.0.1:8091",
+        help="Address to listen on (default: 127.0.0.1:8091)",
+    )
+    return parser.parse_args()
+
+
+# ################################### JOBS ################################### #
+
+
+def submit(branch, args):
+    # Returns the job and whether an identical queued job was reused
+    key = (branch, tuple(args))
+    with _LOCK:
+        queue = _QUEUES.setdefault(branch, deque())
+        for job in queue:
+            if job["key"] == key:
+                return job, True
+
+        job = {
+            "id": next(_IDS),
+            "key": key,
+            "branch": branch,
+            "args": args,
+            "state": "queued",
+            "submitted": time.time(),
+        }
+        queue.append(job)
+        _JOBS[job["id"]] = job
+        metrics.set_value("crowdin_sync_queued_jobs", len(queue), branch=branch)
+
+        worker = _WORKERS.get(branch)
+        if worker is None or not worker.is_alive():
+            worker = threading.Thread(target=work, args=(branch,), daemon=True)
+            _WORKERS[branch] = worker
+            worker.start()
+    return job, False
+
+
+def work(branch):
+    # Jobs of a branch share the same tree, so they are run one after another
+    while True:
+        with _LOCK:
+            queue = _QUEUES[branch]
+            if len(queue) == 0:
+                del _WORKERS[branch]
+                return
+            job = queue.popleft()
+            job["state"] = "running"
+            job["started"] = time.time()
+            metrics.set_value("crowdin_sync_queued_jobs", len(queue), branch=branch)
+
+        print(f"\nRunning job {job['id']}: {branch} {' '.join(job['args'])}")
+        state = run_job(job)
+
+        with _LOCK:
+            job["state"] = state
+            job["finished"] = time.time()
+            metrics.add("crowdin_sync_jobs", branch=branch, result=state)
+            prune_jobs()
+
+
+def run_job(job):
+    branch = job["branch"]
+    try:
+        args = parse_job_args(branch, job["args"])
+        # Once started, the index stays current for all following jobs
+        if args.change_index:
+            change_index.enable(_USERNAME)
+        if args.gerrit:
+            crowdin_sync.run_gerrit(args, branch, _USERNAME)
+        else:
+            base_path = utils.get_base_path(branch)
+            config_dict = utils.get_config_dict(args.config, branch)
+            crowdin_sync.sync_branch(args, branch, base_path, config_dict, _USERNAME)
+    except SystemExit as e:
+        # The pipeline exits on fatal errors, which only ends the job here
+        if e.code not in (None, 0):
+            job["error"] = f"exited with {e.code}"
+            return "failed"
+    except Exception as e:
+        traceback.print_exc()
+        job["error"] = str(e)
+        return "failed"
+    return "done"
+
+
+def parse_job_args(branch, args):
+    # Abbreviations would make it impossible to tell which options are set
+    return crowdin_sync.parse_args(
+        ["-u", _USERNAME, "-b", branch] + args, allow_abbrev=False
+    )
+
+
+def get_forbidden_options(branch, args):
+    # Compare the parsed arguments, so it doesn't matter how the options are spelled
+    defaults = vars(parse_job_args(branch, []))
+    parsed = vars(parse_job_args(branch, args))
+    return [
+        name
+        for name, value in parsed.items()
+        if name not in _JOB_OPTIONS and value != defaults[name]
+    ]
+
+
+def prune_jobs():
+    finished = [i for i, j in _JOBS.items() if j["state"] in ("done", "failed")]
+    for i in finished[: max(0, len(finished) - _MAX_FINISHED_JOBS)]:
+        del _JOBS[i]
+
+
+def get_job_info(job):
+    return {k: v for k, v in job.items() if k != "key"}
+
+
+# ################################### HTTP ################################### #
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/health":
+            with _LOCK:
+                queued = sum(len(q) for q in _QUEUES.values())
+                running = [
+                    j["branch"] for j in _JOBS.values() if j["state"] == "running"
+                ]
+            self.send_json(
+                200,
+                {
+                    "status": "ok",
+                    "uptime": int(time.time() - _START),
+                    "queued": queued,
+                    "running": running,
+                    "open_changes": change_index.get_size(),
+                },
+            )
+        elif self.path == "/metrics":
+            self.send_text(200, metrics.render(), "text/plain; version=0.0.4")
+        elif self.path == "/jobs":
+            with _LOCK:
+                jobs = [get_job_info(j) for j in _JOBS.values()]
+            self.send_json(200, jobs)
+        elif self.path.startswith("/jobs/"):
+            job_id = self.path[len("/jobs/") :]
+            with _LOCK:
+                job = _JOBS.get(int(job_id)) if job_id.isdigit() else None
+                info = None if job is None else get_job_info(job)
+            if info is None:
+                self.send_json(404, {"error": "unknown job"})
+            else:
+                self.send_json(200, info)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            branch = request["branch"]
+            args = [str(a) for a in request.get("args", [])]
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": 'expected {"branch": ..., "args": [...]}'})
+            return
+        try:
+            forbidden = get_forbidden_options(branch, args)
+        except SystemExit:
+            self.send_json(400, {"error": "invalid arguments"})
+            return
+        if len(forbidden) > 0:
+            self.send_json(
+                400, {"error": f"not allowed in jobs: {', '.join(forbidden)}"}
+            )
+            return
+
+        job, duplicate = submit(branch, args)
+        self.send_json(200 if duplicate else 202, get_job_info(job))
+
+    def send_json(self, code, data):
+        self.send_text(code, json.dumps(data) + "\n", "application/json")
+
+    def send_text(self, code, text, content_type):
+        body = text.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} - {format % args}", file=sys.stderr)
+
+
+# ################################### MAIN ################################### #
+
+
+def main():
+    global _USERNAME
+    args = parse_args()
+    _USERNAME = args.username
+
+    import download
+
+    # Everything which is expensive to set up is kept for the following jobs
+    utils.enable_ssh_multiplexing(persist=600)
+    download.enable_repo_cache()
+
+    host, port = args.listen.rsplit(":", 1)
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    print(f"Listening on {args.listen}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
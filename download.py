@@ -21,30 +21,273 @@
 # limitations under the License.
 
 import git
+import heapq
 import os
 import re
 import shutil
 import sys
+import tempfile
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
 
+import change_index
+import journal
+import metrics
+import progress
+import push
+import timeline
 import utils
 
 _COMMITS_CREATED = False
+_CLEAN_CACHE = None
+_CLEAN_CACHE_DIR = None
+_REPO_CACHE = None
 
 
-def download_crowdin(base_path, branch, xml, username, config_dict, crowdin_path):
+def enable_clean_cache():
+    global _CLEAN_CACHE, _CLEAN_CACHE_DIR
+    _CLEAN_CACHE = {}
+    _CLEAN_CACHE_DIR = tempfile.mkdtemp(prefix="crowdin_clean_")
+
+
+def enable_repo_cache():
+    global _REPO_CACHE
+    _REPO_CACHE = {}
+
+
+def download_crowdin(
+    base_path,
+    branch,
+    xml,
+    username,
+    config_dict,
+    crowdin_path,
+    worktree_free=False,
+    shard=None,
+    jobs=8,
+    scope=None,
+    splits=1,
+    rebase=False,
+):
+    start = time.monotonic()
     extracted = []
+    state_name = f"{branch}_download_times"
+    download_times = utils.load_state(state_name)
     for i, cfg in enumerate(config_dict["files"]):
         print(f"\nDownloading translations from Crowdin ({config_dict['headers'][i]})")
-        cmd = [crowdin_path, "download", f"--branch={branch}", f"--config={cfg}"]
-        comm, ret = utils.run_subprocess(cmd, show_spinner=True)
-        if ret != 0:
-            print(f"Failed to download:\n{comm[1]}", file=sys.stderr)
+        cmd = [crowdin_path, "download", f"--branch={branch}"]
+
+        if scope is not None and scope["languages"] is not None:
+            languages = get_scope_languages(cfg, scope, branch)
+            if len(languages) == 0:
+                print("None of the selected languages are translated in this config")
+                continue
+            cmd += [f"--language={lang}" for lang in languages]
+
+        # Narrow the config down to the selected projects. Like the extracted files, the
+        # entries are matched by their translations, which can be in overlays elsewhere.
+        files = utils.load_config(cfg)["files"]
+        if scope is not None and scope["projects"] is not None:
+            files = [
+                f
+                for f in files
+                if utils.in_scope_projects(scope, get_translation_dir(f))
+            ]
+            if len(files) == 0:
+                print("None of the selected projects are translated in this config")
+                continue
+
+        # Huge configs are split into parts which are downloaded in parallel
+        cfg_name = os.path.basename(cfg)
+        times = download_times.setdefault(cfg_name, {})
+        parts = split_files(files, min(splits, len(files)), times, base_path)
+        if len(parts) > 1:
+            print(f"Splitting {len(files)} files into {len(parts)} parallel downloads")
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            results = list(
+                executor.map(
+                    lambda part: download_part(cmd, cfg, part, branch),
+                    [(k, len(parts), p) for k, p in enumerate(parts)],
+                )
+            )
+        if any(r is None for r in results):
             sys.exit(1)
-        extracted += get_extracted_files(comm[0], branch)
+        for part, (part_extracted, duration) in zip(parts, results):
+            extracted += part_extracted
+            # Remember how long each file took, to balance the next split. Within a
+            # part, the duration is attributed by the sizes of the sources.
+            sizes = get_source_sizes(part, base_path)
+            for f, size in zip(part, sizes):
+                times[f["source"]] = duration * (size or 1) / (sum(sizes) or len(part))
+        utils.save_state(state_name, download_times)
+    metrics.add_duration(branch, "download", start)
+
+    extracted = [p for p in extracted if utils.in_scope_projects(scope, p)]
+    upload_translations_gerrit(
+        extracted, xml, base_path, branch, username, worktree_free, shard, jobs, rebase
+    )
+
+
+def get_translation_dir(f):
+    # The directory of the translations of a config entry, up to the first placeholder
+    return os.path.dirname(f["translation"].split("%", 1)[0])
+
+
+def download_part(cmd, cfg, part, branch):
+    # Returns the extracted files and the duration or None if the download failed
+    k, n, files = part
+    stage = f"{branch} crowdin download"
+    tmp_cfg = None
+    # Parts and configs narrowed down to some projects need their own config
+    if len(files) < len(utils.load_config(cfg)["files"]):
+        tmp_cfg = utils.write_config(cfg, files)
+        if n > 1:
+            stage += f" {k + 1}/{n}"
+
+    start = time.monotonic()
+    comm, ret = utils.run_subprocess(cmd + [f"--config={tmp_cfg or cfg}"], stage=stage)
+    duration = time.monotonic() - start
+    if tmp_cfg is not None:
+        os.remove(tmp_cfg)
+    if ret != 0:
+        metrics.add("crowdin_sync_errors", branch=branch, service="crowdin")
+        print(f"Failed to download:\n{comm[1]}", file=sys.stderr)
+        return None
+    return get_extracted_files(comm[0], branch), duration
+
+
+def split_files(files, n, times, base_path):
+    # Balance the parts by the past download times of the files or, if some of them
+    # weren't downloaded before, by the sizes of their sources
+    if n <= 1:
+        return [files]
+    if all(f["source"] in times for f in files):
+        weights = [times[f["source"]] for f in files]
+    else:
+        weights = get_source_sizes(files, base_path)
+    # Sources which aren't checked out still take some time
+    known = [w for w in weights if w > 0]
+    average = sum(known) / len(known) if len(known) > 0 else 1
+    weights = [w or average for w in weights]
+
+    # Greedily put the heaviest remaining file into the lightest part
+    heap = [(0, 0, k) for k in range(n)]
+    parts = [[] for _ in range(n)]
+    order = sorted(range(len(files)), key=lambda j: weights[j], reverse=True)
+    for j in order:
+        weight, count, k = heapq.heappop(heap)
+        parts[k].append(j)
+        heapq.heappush(heap, (weight + weights[j], count + 1, k))
+    # Keep the order of the config within each part
+    return [[files[j] for j in sorted(part)] for part in parts if len(part) > 0]
+
+
+def get_source_sizes(files, base_path):
+    sizes = []
+    for f in files:
+        path = os.path.join(base_path, f["source"].lstrip("/"))
+        sizes.append(os.path.getsize(path) if os.path.isfile(path) else 0)
+    return sizes
 
-    upload_translations_gerrit(extracted, xml, base_path, branch, username)
+
+def get_scope_languages(cfg, scope, branch):
+    # The crowdin CLI fails for languages the project isn't translated to
+    import crowdin_api
+    import requests
+
+    try:
+        targets = crowdin_api.get_target_languages(utils.load_config(cfg)["project_id"])
+    except (requests.RequestException, RuntimeError, KeyError) as e:
+        metrics.add("crowdin_sync_errors", branch=branch, service="crowdin")
+        print(f"Failed to get the languages of {cfg} -- {e}", file=sys.stderr)
+        sys.exit(1)
+    return [lang for lang in scope["languages"] if lang in targets]
+
+
+def download_crowdin_api(
+    base_path,
+    branch,
+    xml,
+    username,
+    config_dict,
+    worktree_free=False,
+    shard=None,
+    jobs=8,
+    incremental=False,
+    scope=None,
+    rebase=False,
+):
+    # Returns False if the API couldn't be used, so the caller can fall back to the CLI
+    import crowdin_api
+    import from_zip
+    import requests
+
+    with tempfile.TemporaryDirectory() as zip_dir:
+        start = time.monotonic()
+        try:
+            zips, translation_progress = crowdin_api.download_translations(
+                config_dict,
+                branch,
+                zip_dir,
+                incremental,
+                scope["languages"] if scope is not None else None,
+            )
+        except (requests.RequestException, RuntimeError, KeyError) as e:
+            metrics.add("crowdin_sync_errors", branch=branch, service="crowdin")
+            print(
+                f"WARNING: Failed to download from the Crowdin API, using the CLI -- {e}",
+                file=sys.stderr,
+            )
+            return False
+        metrics.add_duration(branch, "download", start)
+
+        # Only extract the translations whose progress changed
+        found = set()
+
+        def include(zip_file, filename):
+            if not utils.in_scope_projects(scope, filename):
+                return False
+            if zips[zip_file] is None:
+                return True
+            if filename in zips[zip_file]:
+                found.add((zip_file, filename))
+                return True
+            return False
+
+        from_zip.unzip(
+            list(zips),
+            base_path,
+            branch,
+            xml,
+            username,
+            worktree_free,
+            shard,
+            jobs,
+            include,
+            rebase,
+        )
+
+    # Translations which failed to be pushed have to be downloaded again next time,
+    # the same goes for the projects left to other shards
+    done = not journal.is_active(branch) and not utils.is_interrupted()
+    if incremental and done and shard is None and scope is None:
+        missing = [
+            files[f]
+            for zip_file, files in zips.items()
+            if files is not None
+            for f in files
+            if (zip_file, f) not in found
+        ]
+        if len(missing) > 0:
+            print(
+                f"WARNING: {len(missing)} changed translations weren't in the downloads, "
+                f"they are downloaded again next time",
+                file=sys.stderr,
+            )
+        crowdin_api.save_progress(branch, translation_progress, missing)
+    return True
 
 
 def get_extracted_files(comm, branch):
@@ -59,11 +302,35 @@ def get_extracted_files(comm, branch):
     return extracted
 
 
-def upload_translations_gerrit(extracted, xml, base_path, branch, username):
+def upload_translations_gerrit(
+    extracted,
+    xml,
+    base_path,
+    branch,
+    username,
+    worktree_free=False,
+    shard=None,
+    jobs=8,
+    rebase=False,
+    resume=False,
+    files_path=None,
+):
+    # files_path is where the extracted files are, if they aren't in the tree
+    global _COMMITS_CREATED
     print("\nUploading translations to Gerrit")
-    items = [x for xml_file in xml for x in xml_file.findall("//project")]
+    items = utils.get_projects(xml)
     all_projects = []
+    results = {"pushed": 0, "identical": 0, "empty": 0, "failed": 0, "skipped": 0}
+
+    metrics.add("crowdin_sync_files", len(extracted), branch=branch, result="extracted")
+
+    # Record the progress, unless we are continuing an interrupted run. Otherwise a
+    # journal left in memory by an earlier job of the daemon is replaced as well.
+    if not resume:
+        journal.start(branch, extracted, files_path)
+    files_path = files_path or base_path
 
+    queue = []
     for path in extracted:
         path = path.strip()
         if not path:
@@ -98,194 +365,767 @@ def upload_translations_gerrit(extracted, xml, base_path, branch, username):
         # project in all_projects and check if it's already in there.
         all_projects.append(project_path)
 
-        # Search android/default.xml or config/%(branch)_extra_packages.xml
-        # for the project's name
-        result_path = None
-        result_project = None
-        for project in items:
-            path = project.get("path")
-            if not (project_path + "/").startswith(path + "/"):
-                continue
-            # We want the longest match, so projects in subfolders of other projects are also
-            # taken into account
-            if result_path is None or len(path) > len(result_path):
-                result_path = path
-                result_project = project
+        result_project = utils.find_project(items, project_path)
 
         # Just in case no project was found
-        if result_path is None:
+        if result_project is None:
             continue
 
+        result_path = result_project.get("path")
         if project_path != result_path:
             if result_path in all_projects:
                 continue
             project_path = result_path
             all_projects.append(project_path)
 
+        # Leave the projects of other shards to the other hosts
+        if shard is not None and not utils.in_shard(project_path, shard):
+            results["skipped"] += 1
+            continue
+
+        # Skip what was already finished by an interrupted run
+        step, revision = journal.get_step(branch, project_path)
+        if step in (journal.PUSHED, journal.EMPTY):
+            print(f"\nSkipping {project_path}, already done ({step})")
+            if step == journal.PUSHED:
+                _COMMITS_CREATED = True
+            results[step] += 1
+            continue
+
         project_branch = result_project.get("revision") or branch
         project_name = result_project.get("name")
+        queue.append((project_path, project_name, project_branch))
+
+    # Crowdin lists projects even if nothing changed, so only commit the dirty ones
+    queue, clean = prescan_projects(
+        extracted, base_path, files_path, branch, queue, jobs
+    )
+    results["empty"] += len(clean)
+
+    # Create the commits on top of the latest remote heads, instead of the local ones
+    heads = {}
+    git_version = None
+    if rebase:
+        heads = fetch_heads(queue, base_path, username, branch, jobs)
+        git_version = utils.get_git_version()
+    rebased = {}
+
+    # The number of files of each project, to report the progress of the cleaning
+    counts = {p[0]: len([f for f in extracted if f.startswith(p[0])]) for p in queue}
+    cleaned = f"{branch} cleaned"
+    committed = f"{branch} committed"
+    progress.start(cleaned, sum(counts.values()))
+    progress.start(committed, len(queue))
+
+    start = time.monotonic()
+    pushes = []
+    for project_path, project_name, project_branch in queue:
+        with timeline.span(project_name, "commit"):
+            revision = create_commit(
+                extracted,
+                base_path,
+                project_path,
+                project_name,
+                project_branch,
+                worktree_free,
+                branch,
+                files_path,
+            )
+        progress.advance(cleaned, counts[project_path])
+        progress.advance(committed)
+
+        # The current project might be incomplete, so leave it to --resume
+        if utils.is_interrupted():
+            progress.finish(cleaned)
+            progress.finish(committed)
+            print("\nInterrupted, continue with --resume", file=sys.stderr)
+            return
+
+        if revision is not None and heads.get(project_path) is not None:
+            revision, rebased[project_name] = rebase_commit(
+                get_git_dir(base_path, project_path),
+                revision,
+                heads[project_path],
+                git_version,
+            )
+            if revision is not None:
+                journal.mark(branch, project_path, journal.COMMITTED, revision)
+
+        if revision is None:
+            journal.mark(branch, project_path, journal.EMPTY)
+            results["empty"] += 1
+            continue
+
+        pushes.append(
+            {
+                "project_path": project_path,
+                "name": project_name,
+                "path": get_git_dir(base_path, project_path),
+                "url": f"ssh://{username}@review.lineageos.org:29418/{project_name}",
+                "refspec": f"{revision}:refs/for/{project_branch}%topic=translation",
+                "revision": revision,
+                "project_branch": project_branch,
+                "branch": branch,
+            }
+        )
+    metrics.add_duration(branch, "commit", start)
+
+    progress.finish(cleaned)
+    progress.finish(committed)
+    metrics.add("crowdin_sync_projects", len(pushes), branch=branch, result="committed")
+    if rebase:
+        print_rebase_report(rebased)
+
+    # Pushes identical to an open change are skipped, so look them up first
+    if len(pushes) > 0:
+        open_changes = change_index.get_changes(username)
+        for p in pushes:
+            p["open_changes"] = [
+                c
+                for c in open_changes
+                if c["project"] == p["name"] and c["branch"] == p["project_branch"]
+            ]
+
+    # Push all commits at once, as fast as gerrit lets us
+    if len(pushes) > 0:
+        print(f"\nPushing {len(pushes)} commits")
+    push_start = time.monotonic()
+    push_results = push.push_all(pushes, jobs, f"{branch} pushed")
+    for p, result in zip(pushes, push_results):
+        if "identical" in result:
+            journal.mark(branch, p["project_path"], journal.EMPTY)
+            results["identical"] += 1
+        elif result["success"]:
+            journal.mark(branch, p["project_path"], journal.PUSHED)
+            _COMMITS_CREATED = True
+            results["pushed"] += 1
+        else:
+            results["failed"] += 1
+    metrics.add_duration(branch, "push", push_start)
+    print_open_changes(pushes, push_results)
+    if utils.is_interrupted():
+        print("\nInterrupted, continue with --resume", file=sys.stderr)
+        return
+
+    for project_path in clean:
+        journal.mark(branch, project_path, journal.EMPTY)
+    if len(clean) > 0 and len(queue) > 0:
+        average = (time.monotonic() - start) / len(queue)
+        print(
+            f"\nPrescan skipped {len(clean)} unchanged projects, "
+            f"saving about {average * len(clean):.1f}s"
+        )
+
+    label = branch if shard is None else f"{branch} (shard {shard[0]}/{shard[1]})"
+    summary = (
+        f"{label}: {results['pushed']} projects pushed, "
+        f"{results['identical']} identical to open changes, "
+        f"{results['empty']} without changes, {results['failed']} failed"
+    )
+    if shard is not None:
+        summary += f", {results['skipped']} projects left to other shards"
+    print(f"\n{summary}")
+    for result, count in results.items():
+        metrics.add("crowdin_sync_projects", count, branch=branch, result=result)
+
+    # Keep the journal open so failed pushes can be retried with --resume
+    if results["failed"] == 0:
+        journal.finish(branch)
+    else:
+        print("Some projects failed to push, retry them with --resume", file=sys.stderr)
+
+
+def fetch_heads(projects, base_path, username, branch, jobs):
+    # Fetch the target branches of all projects in parallel, returns their revisions
+    # by project path, None if the fetch failed
+    stage = f"{branch} fetched"
+
+    def fetch_one(project):
+        project_path, project_name, project_branch = project
+        ref = project_branch
+        if not ref.startswith("refs/"):
+            ref = f"refs/heads/{ref}"
+        local_ref = f"refs/crowdin/{ref[len('refs/'):]}"
+        git_cmd = ["git", f"--git-dir={get_git_dir(base_path, project_path)}"]
+        url = f"ssh://{username}@review.lineageos.org:29418/{project_name}"
+        comm, ret = utils.run_subprocess(
+            git_cmd + ["fetch", "--no-tags", url, f"+{ref}:{local_ref}"], silent=True
+        )
+        if ret == 0:
+            comm, ret = utils.run_subprocess(git_cmd + ["rev-parse", local_ref])
+        progress.advance(stage)
+        if ret != 0:
+            metrics.add("crowdin_sync_errors", branch=branch, service="gerrit")
+            print(f"Failed to fetch {project_name} {project_branch}", file=sys.stderr)
+            return None
+        return comm[0].strip()
+
+    start = time.monotonic()
+    progress.start(stage, len(projects))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        revisions = list(executor.map(fetch_one, projects))
+    progress.finish(stage)
+    metrics.add_duration(branch, "fetch", start)
+    return {p[0]: revision for p, revision in zip(projects, revisions)}
+
+
+def rebase_commit(git_dir, revision, upstream, git_version):
+    # Recreates the commit on top of upstream, like a cherry-pick without a worktree.
+    # Returns the revision to push, None if upstream has it already, and the outcome.
+    # git_version is determined once per run, so every commit only runs the merge.
+    git_cmd = ["git", f"--git-dir={git_dir}"]
+
+    def run_git(args, stdin=None):
+        comm, ret = utils.run_subprocess(git_cmd + args, silent=True, stdin=stdin)
+        return comm[0].strip(), ret
+
+    parent, ret = run_git(["rev-parse", f"{revision}^"])
+    if ret != 0 or parent == upstream:
+        return revision, "current"
+
+    # --merge-base needs git 2.40, without it the merge base is only right if the old
+    # parent is an ancestor of upstream, which it usually is
+    cmd = ["merge-tree", "--write-tree", "--no-messages"]
+    if git_version >= (2, 40):
+        cmd.append(f"--merge-base={parent}")
+    elif git_version < (2, 38):
+        return revision, "unsupported"
+    elif run_git(["merge-base", "--is-ancestor", parent, upstream])[1] != 0:
+        return revision, "unsupported"
+    output, ret = run_git(cmd + [upstream, revision])
+    if ret != 0:
+        return revision, "conflict"
+
+    tree = output.split("\n")[0]
+    if tree == run_git(["rev-parse", f"{upstream}^{{tree}}"])[0]:
+        return None, "upstream"
+    message, ret = run_git(["log", "-1", "--format=%B", revision])
+    rebased, ret = run_git(["commit-tree", tree, "-p", upstream], message + "\n")
+    if ret != 0:
+        return revision, "conflict"
+    return rebased, "rebased"
+
+
+def print_rebase_report(rebased):
+    # Commits which couldn't be rebased are pushed on their old parent
+    outcomes = {}
+    for name, outcome in rebased.items():
+        outcomes.setdefault(outcome, []).append(name)
+    print(
+        f"\nRebased {len(outcomes.get('rebased', []))} commits onto the latest remote "
+        f"heads, {len(outcomes.get('current', []))} were up to date, "
+        f"{len(outcomes.get('upstream', []))} already upstream"
+    )
+    for outcome, label in [
+        ("conflict", "don't apply cleanly"),
+        ("unsupported", "can't be rebased with this git version"),
+    ]:
+        if outcome in outcomes:
+            print(
+                f"{len(outcomes[outcome])} commits {label}, pushing them as they are:"
+            )
+            for name in outcomes[outcome]:
+                print(f"  {name}")
+
+
+def print_open_changes(pushes, push_results):
+    # The pushes got new changes next to those
+    superseded = [
+        p
+        for p, r in zip(pushes, push_results)
+        if p["open_changes"] and r["success"] and "identical" not in r
+    ]
+    if len(superseded) == 0:
+        return
+    print(
+        f"\n{len(superseded)} projects already had open translation changes, "
+        f"abandon them with --gerrit abandon:"
+    )
+    for p in superseded:
+        urls = ", ".join(c["url"] for c in p["open_changes"])
+        print(f"  {p['name']}: {urls}")
+
 
-        push_as_commit(
-            extracted, base_path, project_path, project_name, project_branch, username
+def prescan_projects(extracted_files, base_path, files_path, branch, projects, jobs):
+    # Check all projects in parallel with a single cheap git call each
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        dirty = list(
+            executor.map(
+                lambda p: is_dirty(
+                    extracted_files, base_path, files_path, branch, p[0]
+                ),
+                projects,
+            )
+        )
+    duration = time.monotonic() - start
+    metrics.add_duration(branch, "prescan", start)
+
+    queue = [p for p, d in zip(projects, dirty) if d]
+    clean = [p[0] for p, d in zip(projects, dirty) if not d]
+    print(
+        f"\nPrescan: {len(queue)} of {len(projects)} projects have changes "
+        f"({duration:.1f}s)"
+    )
+    return queue, clean
+
+
+def is_dirty(extracted_files, base_path, files_path, branch, project_path):
+    # Projects already cleaned or committed by an interrupted run have to be continued
+    step, revision = journal.get_step(branch, project_path)
+    if step is not None:
+        return True
+
+    names = set()
+    dirs = set()
+    for f in extracted_files:
+        if f.startswith(project_path):
+            names.add(os.path.relpath(f, project_path))
+            dirs.add(os.path.dirname(os.path.relpath(f, project_path)))
+
+    # Files extracted outside of the tree are compared to the committed ones instead
+    if files_path != base_path:
+        cmd = ["git", "-C", os.path.join(base_path, project_path), "ls-tree", "-z"]
+        cmd += ["HEAD", "--"] + sorted(names)
+        comm, ret = utils.run_subprocess(cmd)
+        if ret != 0:
+            return True
+        committed = {}
+        for entry in comm[0].split("\0"):
+            if entry != "":
+                info, name = entry.split("\t", 1)
+                committed[name] = info.split()[2]
+        return any(
+            committed.get(name)
+            != utils.hash_file(
+                os.path.join(files_path, project_path, name), git_blob=True
+            )
+            for name in names
         )
 
+    cmd = ["git", "-C", os.path.join(base_path, project_path), "status"]
+    cmd += ["--porcelain", "-z", "--"] + sorted(dirs)
+    comm, ret = utils.run_subprocess(cmd)
+    # When in doubt, let the commit stage figure it out
+    return ret != 0 or comm[0] != ""
 
-def push_as_commit(
-    extracted_files, base_path, project_path, project_name, branch, username
+
+def create_commit(
+    extracted_files,
+    base_path,
+    project_path,
+    project_name,
+    branch,
+    worktree_free=False,
+    default_branch=None,
+    files_path=None,
 ):
-    global _COMMITS_CREATED
+    # Returns the revision to push or None if there is nothing to push
     print(f"\nCommitting {project_name} on branch {branch}: ")
 
-    # Get path
+    # Create repo object
+    repo = get_repo(base_path, project_path)
+
+    step, revision = journal.get_step(default_branch, project_path)
+    if step == journal.COMMITTED:
+        print(f"Already committed as {revision}")
+    elif worktree_free:
+        revision = commit_without_worktree(
+            extracted_files,
+            files_path or base_path,
+            project_path,
+            repo,
+            default_branch,
+        )
+        if revision is None:
+            print("Nothing to commit")
+            return None
+        journal.mark(default_branch, project_path, journal.COMMITTED, revision)
+    else:
+        # Strip all comments, find incomplete product strings and remove empty files
+        if step != journal.CLEANED:
+            for f in extracted_files:
+                if f.startswith(project_path):
+                    with timeline.span("clean", "clean", file=f):
+                        result = clean_xml_file(os.path.join(base_path, f), repo)
+                    count_cleaned(default_branch, result)
+            journal.mark(default_branch, project_path, journal.CLEANED)
+
+        # Add all files to commit
+        count = add_to_commit(extracted_files, repo, project_path)
+        if count == 0:
+            print("Nothing to commit")
+            return None
+
+        # Create commit; if it fails, probably empty so skipping
+        try:
+            repo.git.commit(m="Automatic translation import")
+        except Exception as e:
+            print(e, "Failed to commit, probably empty: skipping", file=sys.stderr)
+            return None
+        revision = repo.head.commit.hexsha
+        journal.mark(default_branch, project_path, journal.COMMITTED, revision)
+
+    return revision
+
+
+def get_repo(base_path, project_path):
+    # Long running processes keep the repos, and with them GitPython's git processes
+    git_dir = get_git_dir(base_path, project_path)
+    if _REPO_CACHE is None:
+        return git.Repo(git_dir)
+    if git_dir not in _REPO_CACHE:
+        _REPO_CACHE[git_dir] = git.Repo(git_dir)
+    return _REPO_CACHE[git_dir]
+
+
+def get_git_dir(base_path, project_path):
     path = os.path.join(base_path, project_path)
     if not path.endswith(".git"):
         path = os.path.join(path, ".git")
+    return path
 
-    # Create repo object
-    repo = git.Repo(path)
 
-    # Strip all comments, find incomplete product strings and remove empty files
-    for f in extracted_files:
-        if f.startswith(project_path):
-            clean_xml_file(os.path.join(base_path, f), repo)
+def commit_without_worktree(
+    extracted_files, files_path, project_path, repo, default_branch=None
+):
+    # Create the commit from the cleaned files with git plumbing commands and a temporary
+    # index, so neither the checked out files nor the index or HEAD of the repo are touched.
+    # Malformed files are left out, so they keep their committed state.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        added = []
+        removed = []
+        for f in extracted_files:
+            if not f.startswith(project_path):
+                continue
+            name = os.path.relpath(f, project_path)
+            dest = os.path.join(tmp_dir, "files", name)
+            with timeline.span("clean", "clean", file=f):
+                result = clean_xml_file(os.path.join(files_path, f), repo, dest)
+            count_cleaned(default_branch, result)
+            if result == "cleaned":
+                added.append((name, dest))
+            elif result == "removed":
+                removed.append(name)
+        if len(added) == 0 and len(removed) == 0:
+            return None
 
-    # Add all files to commit
-    count = add_to_commit(extracted_files, repo, project_path)
-    if count == 0:
-        print("Nothing to commit")
-        return
+        git_cmd = ["git", f"--git-dir={repo.git_dir}"]
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp_dir, "index"))
 
-    # Create commit; if it fails, probably empty so skipping
-    try:
-        repo.git.commit(m="Automatic translation import")
-    except Exception as e:
-        print(e, "Failed to commit, probably empty: skipping", file=sys.stderr)
-        return
+        def run_git(args, stdin=None):
+            comm, ret = utils.run_subprocess(git_cmd + args, stdin=stdin, env=env)
+            if ret != 0:
+                raise RuntimeError(f"git {args[0]} failed")
+            return comm[0].strip()
+
+        try:
+            run_git(["read-tree", "HEAD"])
+            # Write all blobs with a single process
+            blobs = run_git(
+                ["hash-object", "-w", "--stdin-paths"],
+                "\n".join(dest for name, dest in added) + "\n",
+            ).split("\n")
+            index_info = [
+                f"100644 {blob}\t{name}" for (name, dest), blob in zip(added, blobs)
+            ]
+            index_info += [f"0 {'0' * 40}\t{name}" for name in removed]
+            run_git(["update-index", "--index-info"], "\n".join(index_info) + "\n")
+            tree = run_git(["write-tree"])
+            if tree == repo.head.commit.tree.hexsha:
+                return None
+            return run_git(
+                ["commit-tree", tree, "-p", "HEAD"], "Automatic translation import\n"
+            )
+        except RuntimeError as e:
+            print(e, "Failed to commit: skipping", file=sys.stderr)
+            return None
 
-    # Push commit
-    try:
-        repo.git.push(
-            f"ssh://{username}@review.lineageos.org:29418/{project_name}",
-            f"HEAD:refs/for/{branch}%topic=translation",
-        )
-        print("Successfully pushed!")
-    except Exception as e:
-        print(e, "Failed to push!", file=sys.stderr)
-        return
 
-    _COMMITS_CREATED = True
+def count_cleaned(branch, result):
+    # Malformed files are reset to their previous state
+    result = {"malformed": "reset", None: "failed"}.get(result, result)
+    metrics.add("crowdin_sync_files", branch=branch, result=result)
 
 
-def clean_xml_file(path, repo):
+# Returns "cleaned" or "removed" depending on the outcome, "malformed" if the file can't be
+# parsed and None on errors. If dest is specified, the cleaned file is written there instead
+# and the original file is left untouched.
+def clean_xml_file(path, repo, dest=None):
     # We don't want to create every file, just work with those already existing
     if not os.path.isfile(path):
         print(f"Called clean_xml_file, but not a file: {path}")
-        return
+        return None
     print(f"Cleaning file {path}")
 
-    try:
-        fh = open(path, "r+")
-    except OSError:
-        print(f"Something went wrong while opening file {path}")
-        return
-
-    xml = fh.read()
-    content = ""
-
-    # Take the original xml declaration and prepend it
-    declaration = xml.split("\n")[0]
-    if "<?" in declaration:
-        content = declaration + "\n"
-        start_pos = xml.find("\n") + 1
-        xml = xml[start_pos:]
+    # Identical files are shared between branches, so only clean them once
+    key = None
+    if _CLEAN_CACHE is not None:
+        key = utils.hash_file(path)
+        if key in _CLEAN_CACHE:
+            cached = _CLEAN_CACHE[key]
+            if cached is None:
+                remove_cleaned_file(path, dest)
+                return "removed"
+            replace_file(cached, dest or path, path)
+            return "cleaned"
 
+    # The file is streamed twice: Once to find out what has to be removed and once to
+    # write the cleaned file, so the memory usage doesn't depend on the file size
     try:
-        parser = etree.XMLParser(strip_cdata=False)
-        tree = etree.parse(path, parser=parser).getroot()
+        declaration, header, missing_default, pretty = scan_xml_file(path)
+        if dest is not None:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(dest or path), suffix=".tmp"
+        )
     except etree.XMLSyntaxError as err:
         print(f"{path}: XML Error: {err}")
         filename, ext = os.path.splitext(path)
-        if ext == ".xml":
+        if ext == ".xml" and dest is None:
             reset_file(path, repo)
-        return
+        return "malformed"
+    except OSError:
+        print(f"Something went wrong while opening file {path}")
+        return None
 
-    # Remove strings with 'product=*' attribute but no 'product=default'
-    # This will ensure aapt2 will not throw an error when building these
-    already_removed = []
-    product_strings = tree.xpath("//string[@product]")
-    for ps in product_strings:
-        # if we already removed the items, don't process them
-        if ps in already_removed:
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            count = write_cleaned_xml(
+                path, fh, declaration, header, missing_default, pretty
+            )
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    # Remove files which don't have any translated strings
+    if count == 0:
+        os.remove(tmp_path)
+        remove_cleaned_file(path, dest)
+        if key is not None:
+            _CLEAN_CACHE[key] = None
+        return "removed"
+
+    if key is not None:
+        # Other threads may clean the same file at the same time and read the
+        # cached copy as soon as it is published, so only move complete copies there
+        cached = os.path.join(_CLEAN_CACHE_DIR, key)
+        cache_fd, cache_tmp = tempfile.mkstemp(dir=_CLEAN_CACHE_DIR, suffix=".tmp")
+        os.close(cache_fd)
+        shutil.copyfile(tmp_path, cache_tmp)
+        os.replace(cache_tmp, cached)
+        _CLEAN_CACHE[key] = cached
+
+    # Overwrite file with content stripped by all comments
+    shutil.copymode(path, tmp_path)
+    os.replace(tmp_path, dest or path)
+    return "cleaned"
+
+
+def scan_xml_file(path):
+    # Take the original xml declaration, so it can be prepended again
+    with open(path, "r") as fh:
+        declaration = fh.readline().rstrip("\n")
+    if "<?" not in declaration:
+        declaration = None
+
+    header = []
+    has_default = set()
+    has_product = set()
+    # lxml only pretty prints files without any text between the children of the root,
+    # not even whitespace. The text after an element is removed together with it, so
+    # the text after strings with a product only counts if they are kept.
+    has_text = False
+    tailed_products = set()
+    root = None
+    last = None
+    depth = 0
+    parser_args = {"events": ("start", "end", "comment"), "strip_cdata": False}
+    for event, elem in etree.iterparse(path, **parser_args):
+        # Each child of the root and its end finish the text in front of them
+        if depth == 1:
+            if last is None:
+                has_text = has_text or bool(root.text)
+            elif last[0].tail and last[1] is True:
+                has_text = True
+            elif last[0].tail and last[1] is not None:
+                tailed_products.add(last[1])
+
+        if event == "start":
+            if depth == 0:
+                root = elem
+            depth += 1
+            continue
+        if event == "comment":
+            # Keep all comments in header
+            if depth == 0:
+                header.append(str(elem).replace("\\n", "\n").replace("\\t", "\t"))
+            continue
+        depth -= 1
+        if depth != 1:
             continue
-        string_name = ps.get("name")
-        strings_with_same_name = tree.xpath("//string[@name='{0}']".format(string_name))
 
         # We want to find strings with product='default' or no product attribute at all
-        has_product_default = False
-        for string in strings_with_same_name:
-            product = string.get("product")
+        if elem.tag == "string":
+            product = elem.get("product")
             if product is None or product == "default":
-                has_product_default = True
-                break
+                has_default.add(elem.get("name"))
+            else:
+                has_product.add(elem.get("name"))
 
-        # Every occurrence of the string has to be removed when no string with the same name and
-        # 'product=default' (or no product attribute) was found
-        if not has_product_default:
-            print(
-                f"{path}: Found string '{string_name}' with missing 'product=default' attribute"
-            )
-            for string in strings_with_same_name:
-                tree.remove(string)
-                already_removed.append(string)
-
-    header = ""
-    comments = tree.xpath("//comment()")
-    for c in comments:
-        p = c.getparent()
-        if p is None:
-            # Keep all comments in header
-            header += str(c).replace("\\n", "\n").replace("\\t", "\t") + "\n"
-            continue
-        # remove the other comments
-        p.remove(c)
+        if root.tag == "resources" and elem.get("translatable") == "false":
+            last = (elem, None)
+        elif elem.tag == "string" and elem.get("product") not in (None, "default"):
+            last = (elem, elem.get("name"))
+        else:
+            last = (elem, True)
 
-    # Remove string(-array)s that are marked as non-translatable
-    non_translatable = tree.xpath('/resources/*[@translatable="false"]')
-    for n in non_translatable:
-        tree.remove(n)
+        # Free what we've already seen, the tail is only parsed after the element
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
-    # Take the original xml declaration and prepend it
-    declaration = xml.split("\n")[0]
-    if "<?" in declaration:
-        content = declaration + "\n"
+    # Every occurrence of a string has to be removed when no string with the same name and
+    # 'product=default' (or no product attribute) was found
+    # This will ensure aapt2 will not throw an error when building these
+    missing_default = has_product - has_default
+    for name in sorted(missing_default):
+        print(f"{path}: Found string '{name}' with missing 'product=default' attribute")
 
-    content += etree.tostring(
-        tree, pretty_print=True, encoding="unicode", xml_declaration=False
-    )
+    pretty = not has_text and len(tailed_products - missing_default) == 0
+    return declaration, header, missing_default, pretty
+
+
+def write_cleaned_xml(path, fh, declaration, header, missing_default, pretty=False):
+    if declaration is not None:
+        fh.write((declaration + "\n").encode("utf-8"))
+        for comment in header:
+            fh.write((comment + "\n").encode("utf-8"))
+    if pretty:
+        return write_pretty_xml(path, fh, missing_default)
+
+    count = 0
+    depth = 0
+    root = None
+    # Whitespace in front of the next kept element, tails are only known after the element
+    text = None
+    last_kept = None
+    parser_args = {"events": ("start", "end", "comment"), "strip_cdata": False}
+    for event, elem in etree.iterparse(path, **parser_args):
+        if event == "start" and depth == 0:
+            root = elem
+            start_tag, end_tag = get_root_tags(root)
+            fh.write(start_tag)
+            depth += 1
+            continue
+
+        if depth == 1 and event in ("start", "comment"):
+            if text is None:
+                text = root.text or ""
+            if last_kept is not None:
+                text = last_kept.tail or ""
+                last_kept.clear()
+                last_kept = None
+
+        if event == "start":
+            depth += 1
+        elif event == "end":
+            depth -= 1
+            if depth == 1:
+                if keep_element(root, elem, missing_default):
+                    # Remove the comments within
+                    for c in list(elem.iter(etree.Comment)):
+                        c.getparent().remove(c)
+                    fh.write(text.encode("utf-8"))
+                    fh.write(serialize_child(root, elem))
+                    last_kept = elem
+                    count += 1
+                # Free what was already written
+                while elem.getprevious() is not None:
+                    del root[0]
+            elif depth == 0:
+                if last_kept is not None:
+                    text = last_kept.tail or ""
+                elif text is None:
+                    text = root.text or ""
+                # Sometimes spaces are added right before the end, we don't want them
+                if root.tag == "resources":
+                    text = re.sub(r"[ ]*\Z", "", text)
+                fh.write(text.encode("utf-8"))
+                fh.write(end_tag + b"\n")
+    return count
 
-    if header != "":
-        content = content.replace("?>\n", "?>\n" + header)
 
-    # Sometimes spaces are added, we don't want them
+def write_pretty_xml(path, fh, missing_default):
+    # Files without any whitespace between the elements are usually small, so they are
+    # cleaned in memory and pretty printed by lxml
+    root = etree.parse(path, etree.XMLParser(strip_cdata=False)).getroot()
+    for c in list(root.iter(etree.Comment)):
+        c.getparent().remove(c)
+    for elem in list(root):
+        if not keep_element(root, elem, missing_default):
+            root.remove(elem)
+    content = etree.tostring(root, pretty_print=True, encoding="unicode")
     content = re.sub(r"[ ]*</resources>", r"</resources>", content)
+    fh.write(content.encode("utf-8"))
+    return len(root)
 
-    # Overwrite file with content stripped by all comments
-    fh.seek(0)
-    fh.write(content)
-    fh.truncate()
-    fh.close()
 
-    # Remove files which don't have any translated strings
-    content_list = list(tree)
-    if len(content_list) == 0:
-        print(f"Removing {path}")
-        os.remove(path)
-        # If that was the last file in the folder, we need to remove the folder as well
-        dir_name = os.path.dirname(path)
-        if os.path.isdir(dir_name):
-            if not os.listdir(dir_name):
-                print(f"Removing {dir_name}")
-                os.rmdir(dir_name)
+def get_root_tags(root):
+    # Serialize the root element while it is still empty to get its start tag
+    shallow = etree.tostring(root, encoding="unicode", with_tail=False)
+    if shallow.endswith("/>"):
+        start_tag = shallow[:-2] + ">"
+    else:
+        start_tag = shallow[: shallow.index(">") + 1]
+    name = re.match(r"<([^\s/>]+)", start_tag).group(1)
+    return start_tag.encode("utf-8"), f"</{name}>".encode("utf-8")
+
+
+def serialize_child(root, elem):
+    # lxml declares all namespaces in scope on serialized children, but the root
+    # already declares them
+    content = etree.tostring(elem, encoding="unicode", with_tail=False)
+    end = content.index(">")
+    start_tag = content[:end]
+    for prefix, uri in root.nsmap.items():
+        attr = "xmlns" if prefix is None else f"xmlns:{prefix}"
+        start_tag = start_tag.replace(f' {attr}="{uri}"', "", 1)
+    return (start_tag + content[end:]).encode("utf-8")
+
+
+def keep_element(root, elem, missing_default):
+    # Remove string(-array)s that are marked as non-translatable
+    if root.tag == "resources" and elem.get("translatable") == "false":
+        return False
+    # Remove strings with 'product=*' attribute but no 'product=default'
+    if elem.tag == "string" and elem.get("name") in missing_default:
+        return False
+    return True
+
+
+def remove_cleaned_file(path, dest):
+    # The original file is only removed when cleaning it in place
+    if dest is not None:
+        return
+    print(f"Removing {path}")
+    os.remove(path)
+    # If that was the last file in the folder, we need to remove the folder as well
+    dir_name = os.path.dirname(path)
+    if os.path.isdir(dir_name):
+        if not os.listdir(dir_name):
+            print(f"Removing {dir_name}")
+            os.rmdir(dir_name)
+
+
+def replace_file(src, dest, mode_from):
+    # Copy to a temporary file next to dest first, so dest is replaced atomically
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix=".tmp")
+    os.close(fd)
+    shutil.copyfile(src, tmp_path)
+    shutil.copymode(mode_from, tmp_path)
+    os.replace(tmp_path, dest)
 
 
 def add_to_commit(extracted_files, repo, project_path):
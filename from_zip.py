@@ -20,17 +20,44 @@
 # limitations under the License.
 
 import os
+import shutil
+import time
 import zipfile
 
 from pathlib import Path
 
 import download
+import metrics
+import progress
+import utils
 
 
-def unzip(zip_files, base_path, branch, xml, username):
+def unzip(
+    zip_files,
+    base_path,
+    branch,
+    xml,
+    username,
+    worktree_free=False,
+    shard=None,
+    jobs=8,
+    include=None,
+    rebase=False,
+):
+    # include can limit the extracted files, it's called with the zip and the path of a file
     print("\nUnzipping files")
     extracted = []
     number = 1
+    stage = f"{branch} extracted"
+    progress.start(stage, 0)
+    start = time.monotonic()
+
+    # Without a worktree the files are extracted to the state directory instead, so
+    # the checked out trees stay untouched. They are kept for --resume until the next run.
+    files_path = base_path
+    if worktree_free:
+        files_path = os.path.join(utils.get_state_dir(), f"{branch}_extracted")
+        shutil.rmtree(files_path, ignore_errors=True)
 
     for zip_file in zip_files:
         if not zipfile.is_zipfile(zip_file):
@@ -41,19 +68,40 @@ def unzip(zip_files, base_path, branch, xml, username):
 
         print(f"File {number}/{len(zip_files)}")
         with zipfile.ZipFile(zip_file, "r") as my_zip:
+            members = []
             for zip_info in my_zip.infolist():
                 filename = zip_info.filename
                 if filename.startswith(branch) and filename.endswith(".xml"):
                     p = Path(filename)
                     # get rid of the parent folder
                     filename = os.path.join(*list(p.parts[1:]))
+                    if include is not None and not include(zip_file, filename):
+                        continue
                     zip_info.filename = filename
-                    if filename not in extracted:
-                        extracted.append(filename)
-                    my_zip.extract(zip_info, path=base_path)
+                    members.append(zip_info)
+
+            progress.add_total(stage, len(members))
+            for zip_info in members:
+                if zip_info.filename not in extracted:
+                    extracted.append(zip_info.filename)
+                my_zip.extract(zip_info, path=files_path)
+                progress.advance(stage)
         number += 1
+    progress.finish(stage)
+    metrics.add_duration(branch, "extract", start)
 
     if len(extracted) > 0:
-        download.upload_translations_gerrit(extracted, xml, base_path, branch, username)
+        download.upload_translations_gerrit(
+            extracted,
+            xml,
+            base_path,
+            branch,
+            username,
+            worktree_free,
+            shard,
+            jobs,
+            rebase,
+            files_path=files_path,
+        )
     else:
         print("Nothing extracted or no new files found!")
@@ -23,6 +23,8 @@ import json
 import re
 import sys
 
+import change_index
+import metrics
 import utils
 
 
@@ -41,9 +43,11 @@ def abandon(branch, username, owner, uploader, message):
             cmd += ["--message", f"'{message}'"]
         msg, code = utils.run_subprocess(cmd, True)
         if code != 0:
+            metrics.add("crowdin_sync_errors", branch=branch, service="gerrit")
             error_text = msg[1].replace("\n\n", "; ").replace("\n", "")
             print(f"Failed! -- {error_text}")
         else:
+            change_index.discard(change)
             print("Success")
 
         commits += 1
@@ -67,9 +71,11 @@ def submit(branch, username, owner, uploader):
         ]
         msg, code = utils.run_subprocess(cmd, True)
         if code != 0:
+            metrics.add("crowdin_sync_errors", branch=branch, service="gerrit")
             error_text = msg[1].replace("\n\n", "; ").replace("\n", "")
             print(f"Failed! -- {error_text}")
         else:
+            change_index.discard(change)
             print("Success")
 
         commits += 1
@@ -94,6 +100,7 @@ def vote(branch, username, owner, uploader, message):
             cmd += ["--message", f"'{message}'"]
         msg, code = utils.run_subprocess(cmd, True)
         if code != 0:
+            metrics.add("crowdin_sync_errors", branch=branch, service="gerrit")
             error_text = msg[1].replace("\n\n", "; ").replace("\n", "")
             print(f"Failed! -- {error_text}")
         else:
@@ -106,17 +113,19 @@ def vote(branch, username, owner, uploader, message):
 
 
 def get_open_changes(branch, username, owner, uploader):
+    branches = get_branches(branch)
+    changes = change_index.get_open_changes(branches, owner, uploader)
+    if changes is not None:
+        return changes
+
     print("Fetching open changes on gerrit")
 
     # If an owner/uploader is specified, modify the query, so we only get the ones wanted
     owner_arg = "" if owner is None else f"owner:{owner}"
     uploader_arg = "" if uploader is None else f"uploader:{uploader}"
-
-    # If branch is >= lineage-20.0, we want to also get lineage-20 changes
-    if re.match(r"^lineage-[2-9]\d\.\d$", branch):
-        branch_arg = f"(branch:{branch} or branch:{branch[:-2]})"
-    else:
-        branch_arg = f"branch:{branch}"
+    branch_arg = " or ".join(f"branch:{b}" for b in branches)
+    if len(branches) > 1:
+        branch_arg = f"({branch_arg})"
 
     # Find all open translation changes
     cmd = utils.get_gerrit_base_cmd(username) + [
@@ -132,6 +141,7 @@ def get_open_changes(branch, username, owner, uploader):
     ]
     msg, code = utils.run_subprocess(cmd)
     if code != 0:
+        metrics.add("crowdin_sync_errors", branch=branch, service="gerrit")
         print(f"Failed: {msg[1]}", file=sys.stderr)
         sys.exit(1)
 
@@ -152,3 +162,10 @@ def get_open_changes(branch, username, owner, uploader):
             )
 
     return changes
+
+
+def get_branches(branch):
+    # If branch is >= lineage-20.0, we want to also get lineage-20 changes
+    if re.match(r"^lineage-[2-9]\d\.\d$", branch):
+        return [branch, branch[:-2]]
+    return [branch]
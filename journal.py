@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# journal.py
+#
+# Helper script for recording the progress of a translation import,
+# so interrupted runs can be resumed
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import utils
+
+# Steps a project goes through, "pushed" and "empty" mean that it's done
+CLEANED = "cleaned"
+COMMITTED = "committed"
+PUSHED = "pushed"
+EMPTY = "empty"
+
+_JOURNALS = {}
+
+
+def start(branch, extracted, files_path=None):
+    # A new run replaces whatever journal was left over by an earlier one. files_path
+    # is where the extracted files are, if they weren't extracted to the tree.
+    _JOURNALS[branch] = {
+        "started": int(time.time()),
+        "extracted": extracted,
+        "files_path": files_path,
+        "projects": {},
+        "done": False,
+    }
+    save(branch)
+
+
+def load(branch):
+    journal = utils.load_state(get_name(branch))
+    if not journal or journal["done"]:
+        return False
+    _JOURNALS[branch] = journal
+    return True
+
+
+def is_active(branch):
+    return branch in _JOURNALS and not _JOURNALS[branch]["done"]
+
+
+def is_running():
+    return any(is_active(branch) for branch in _JOURNALS)
+
+
+def get_extracted(branch):
+    return _JOURNALS[branch]["extracted"]
+
+
+def get_files_path(branch):
+    return _JOURNALS[branch].get("files_path")
+
+
+def get_step(branch, project_path):
+    if branch not in _JOURNALS:
+        return None, None
+    entry = _JOURNALS[branch]["projects"].get(project_path, {})
+    return entry.get("step"), entry.get("revision")
+
+
+def mark(branch, project_path, step, revision=None):
+    if branch not in _JOURNALS:
+        return
+    entry = {"step": step}
+    if revision is not None:
+        entry["revision"] = revision
+    _JOURNALS[branch]["projects"][project_path] = entry
+    save(branch)
+
+
+def finish(branch):
+    if branch not in _JOURNALS:
+        return
+    _JOURNALS[branch]["done"] = True
+    save(branch)
+
+
+def save(branch):
+    utils.save_state(get_name(branch), _JOURNALS[branch])
+
+
+def get_name(branch):
+    return f"{branch}_journal"
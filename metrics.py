@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# metrics.py
+#
+# Helper script for collecting metrics of a run and writing them
+# for the textfile collector of the Prometheus node exporter
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import os
+import threading
+import time
+
+# All metrics describe the last run, so they are gauges
+_HELP = {
+    "crowdin_sync_stage_duration_seconds": "Duration of the stages of the last run",
+    "crowdin_sync_files": "Translation files of the last run by result",
+    "crowdin_sync_projects": "Projects of the last run by result",
+    "crowdin_sync_subprocesses": "Subprocesses started by the last run by command",
+    "crowdin_sync_errors": "Errors of the last run by service",
+    "crowdin_sync_avoided_push_bytes": "Push traffic avoided by the last run",
+    "crowdin_sync_jobs": "Jobs handled by the daemon by result",
+    "crowdin_sync_queued_jobs": "Jobs waiting in the queue of the daemon by branch",
+    "crowdin_sync_run_duration_seconds": "Duration of the last run",
+    "crowdin_sync_last_run_timestamp_seconds": "Time the last run finished",
+    "crowdin_sync_exit_code": "Exit code of the last run",
+}
+
+_LOCK = threading.Lock()
+_METRICS = {}
+_START = time.monotonic()
+_EXIT_CODE = None
+
+
+def add(name, value=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with _LOCK:
+        values = _METRICS.setdefault(name, {})
+        values[key] = values.get(key, 0) + value
+
+
+def set_value(name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with _LOCK:
+        _METRICS.setdefault(name, {})[key] = value
+
+
+def add_duration(branch, stage, start):
+    # start is a time.monotonic() timestamp
+    add(
+        "crowdin_sync_stage_duration_seconds",
+        time.monotonic() - start,
+        branch=branch,
+        stage=stage,
+    )
+
+
+def set_exit_code(code):
+    # Like sys.exit(), None means success and other objects failure
+    global _EXIT_CODE
+    if code is None:
+        code = 0
+    _EXIT_CODE = code if isinstance(code, int) else 1
+
+
+def enable(path):
+    # Write the metrics when the run ends, no matter where it exits
+    atexit.register(write, path)
+
+
+def render():
+    with _LOCK:
+        metrics = {name: dict(values) for name, values in _METRICS.items()}
+    metrics["crowdin_sync_run_duration_seconds"] = {(): time.monotonic() - _START}
+    metrics["crowdin_sync_last_run_timestamp_seconds"] = {(): time.time()}
+    if _EXIT_CODE is not None:
+        metrics["crowdin_sync_exit_code"] = {(): _EXIT_CODE}
+
+    lines = []
+    for name in _HELP:
+        if name not in metrics:
+            continue
+        lines.append(f"# HELP {name} {_HELP[name]}")
+        lines.append(f"# TYPE {name} gauge")
+        for key, value in sorted(metrics[name].items()):
+            labels = ",".join(f'{k}="{escape(v)}"' for k, v in key)
+            labels = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write(path):
+    # The collector must never see a half written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fh:
+        fh.write(render())
+    os.replace(tmp_path, path)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# progress.py
+#
+# Helper script for reporting the progress of the stages of a sync,
+# e.g. the number of cleaned files, with their throughput and ETA
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import shutil
+import sys
+import threading
+import time
+
+import timeline
+
+# On a terminal the status line is redrawn frequently, otherwise (e.g. in cron jobs)
+# a line per stage is logged every now and then
+_TTY_INTERVAL = 0.5
+_LOG_INTERVAL = 30
+
+# Stages are shared by all workers, so only access them while holding the lock
+_LOCK = threading.Lock()
+_STAGES = {}
+_THREAD = None
+
+
+def start(stage, total=None):
+    # Stages without a total just show how long they have been running
+    global _THREAD
+    with _LOCK:
+        _STAGES[stage] = {"done": 0, "total": total, "start": time.monotonic()}
+        if _THREAD is None:
+            _THREAD = threading.Thread(target=report, daemon=True)
+            _THREAD.start()
+
+
+def add_total(stage, n):
+    with _LOCK:
+        if stage in _STAGES:
+            _STAGES[stage]["total"] = (_STAGES[stage]["total"] or 0) + n
+
+
+def advance(stage, n=1):
+    with _LOCK:
+        if stage in _STAGES:
+            _STAGES[stage]["done"] += n
+
+
+def finish(stage):
+    with _LOCK:
+        state = _STAGES.pop(stage, None)
+        if state is None:
+            return
+        timeline.add_span(stage, "stage", state["start"])
+        if sys.stdout.isatty():
+            sys.stdout.write("\x1b[1K\r")
+        if state["done"] > 0:
+            elapsed = time.monotonic() - state["start"]
+            print(
+                f"{stage}: {state['done']} in {format_duration(elapsed)} "
+                f"({state['done'] / max(elapsed, 0.001):.1f}/s)"
+            )
+        sys.stdout.flush()
+
+
+def report():
+    tty = sys.stdout.isatty()
+    last_log = time.monotonic()
+    while True:
+        time.sleep(_TTY_INTERVAL)
+        with _LOCK:
+            lines = [format_stage(stage, state) for stage, state in _STAGES.items()]
+            if len(lines) == 0:
+                continue
+            if tty:
+                width = shutil.get_terminal_size().columns - 1
+                sys.stdout.write("\x1b[1K\r" + " | ".join(lines)[:width])
+                sys.stdout.flush()
+            elif time.monotonic() - last_log >= _LOG_INTERVAL:
+                for line in lines:
+                    print(f"[progress] {line}", flush=True)
+                last_log = time.monotonic()
+
+
+def format_stage(stage, state):
+    elapsed = time.monotonic() - state["start"]
+    done = state["done"]
+    total = state["total"]
+    if total is None and done == 0:
+        return f"{stage}: {format_duration(elapsed)}"
+
+    text = f"{stage}: {done}" if total is None else f"{stage}: {done}/{total}"
+    if done > 0:
+        rate = done / max(elapsed, 0.001)
+        text += f" ({rate:.1f}/s"
+        if total is not None and total > done:
+            text += f", ETA {format_duration((total - done) / rate)}"
+        text += ")"
+    return text
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return f"{hours}h{minutes:02d}m"
+    return f"{minutes}m{seconds:02d}s"
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# push.py
+#
+# Helper script for pushing translation commits to LineageOS' gerrit
+# without getting throttled
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import progress
+import timeline
+import utils
+
+# Gerrit output of failures which are worth retrying, as they mostly mean that we
+# are pushing too fast or the connection dropped
+_TRANSIENT_ERRORS = [
+    "too many",
+    "rate limit",
+    "throttl",
+    "try again",
+    "temporarily",
+    "timed out",
+    "timeout",
+    "connection reset",
+    "connection closed",
+    "connection refused",
+    "broken pipe",
+    "could not read from remote",
+    "remote end hung up",
+    "early eof",
+    "exchange_identification",
+    "service unavailable",
+]
+_MAX_ATTEMPTS = 5
+_BACKOFF_BASE = 2
+_BACKOFF_MAX = 60
+
+# The number of concurrent pushes is adapted like the AIMD congestion control of TCP:
+# Every fast push increases it additively, slow pushes and transient errors decrease it
+# multiplicatively. It's shared by all branches, since they push to the same server.
+_CONDITION = threading.Condition()
+_WINDOW = 1.0
+_ACTIVE = 0
+_LATENCY = None
+
+
+def push_all(pushes, max_concurrency, stage="pushed"):
+    # pushes are dicts with name, path (of the git dir), url, refspec, revision, branch
+    # and the open_changes of the project, the results are returned in the same order
+    def push_one(push):
+        with timeline.span(push["name"], "push") as args:
+            result = push_with_retries(push, max_concurrency)
+            args["attempts"] = result["attempts"]
+        progress.advance(stage)
+        return result
+
+    progress.start(stage, len(pushes))
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        results = list(executor.map(push_one, pushes))
+    progress.finish(stage)
+    print_retry_report(results)
+    print_identical_report(pushes, results)
+    return results
+
+
+def push_with_retries(push, max_concurrency):
+    result = {"name": push["name"], "success": False, "attempts": 0}
+    # Pushing the same content again would only create a useless change and CI run
+    change = find_identical_change(push, max_concurrency)
+    if change is not None:
+        print(f"Skipping {push['name']}, identical to {change['url']}")
+        result["success"] = True
+        result["identical"] = change["url"]
+        result["size"] = get_push_size(push)
+        return result
+
+    result["error"] = "interrupted"
+    while result["attempts"] < _MAX_ATTEMPTS and not utils.is_interrupted():
+        result["attempts"] += 1
+        acquire_slot(max_concurrency)
+        start = time.monotonic()
+        cmd = ["git", f"--git-dir={push['path']}", "push", push["url"], push["refspec"]]
+        comm, ret = utils.run_subprocess(cmd, silent=True)
+        latency = time.monotonic() - start
+
+        if ret == 0:
+            release_slot(latency, None, max_concurrency)
+            print(f"Successfully pushed {push['name']}!")
+            result["success"] = True
+            return result
+
+        error = comm[1].strip()
+        transient = is_transient(error)
+        metrics.add("crowdin_sync_errors", branch=push.get("branch"), service="gerrit")
+        release_slot(latency, transient, max_concurrency)
+        result["error"] = error.replace("\n", "; ")
+        if not transient:
+            break
+
+        # Full jitter, so the retries of concurrent pushes don't line up again
+        delay = random.uniform(
+            0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2 ** result["attempts"])
+        )
+        print(f"Pushing {push['name']} failed, retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+    print(f"Failed to push {push['name']}! -- {result['error']}", file=sys.stderr)
+    return result
+
+
+def find_identical_change(push, max_concurrency):
+    git_cmd = ["git", f"--git-dir={push['path']}"]
+    changes = push.get("open_changes") or []
+    tree = get_tree(git_cmd, push["revision"]) if len(changes) > 0 else None
+    for change in changes:
+        # Changes pushed by other hosts have to be fetched first, which is still
+        # cheaper than pushing
+        if get_tree(git_cmd, change["revision"]) is None:
+            number = change["number"]
+            ref = f"refs/changes/{number % 100:02d}/{number}/{change['patch_set']}"
+            acquire_slot(max_concurrency)
+            utils.run_subprocess(
+                git_cmd + ["fetch", "--no-tags", push["url"], ref], silent=True
+            )
+            release_slot(0, False, max_concurrency)
+        if tree is not None and get_tree(git_cmd, change["revision"]) == tree:
+            return change
+    return None
+
+
+def get_tree(git_cmd, revision):
+    comm, ret = utils.run_subprocess(
+        git_cmd + ["rev-parse", "--verify", "-q", f"{revision}^{{tree}}"], silent=True
+    )
+    return comm[0].strip() if ret == 0 else None
+
+
+def get_push_size(push):
+    # The size of the objects the push would have sent, the base is on the server
+    git_cmd = ["git", f"--git-dir={push['path']}"]
+    revision = push["revision"]
+    comm, ret = utils.run_subprocess(
+        git_cmd + ["rev-list", "--objects", revision, "--not", f"{revision}^@"],
+        silent=True,
+    )
+    if ret != 0:
+        return 0
+    objects = "\n".join(line.split(" ")[0] for line in comm[0].splitlines())
+    comm, ret = utils.run_subprocess(
+        git_cmd + ["cat-file", "--batch-check=%(objectsize:disk)"],
+        silent=True,
+        stdin=objects + "\n",
+    )
+    if ret != 0:
+        return 0
+    return sum(int(size) for size in comm[0].split())
+
+
+def is_transient(error):
+    error = error.lower()
+    return any(e in error for e in _TRANSIENT_ERRORS)
+
+
+def acquire_slot(max_concurrency):
+    global _ACTIVE
+    with _CONDITION:
+        while _ACTIVE >= min(int(_WINDOW), max_concurrency):
+            _CONDITION.wait()
+        _ACTIVE += 1
+
+
+def release_slot(latency, transient, max_concurrency):
+    global _ACTIVE, _WINDOW, _LATENCY
+    with _CONDITION:
+        _ACTIVE -= 1
+        if transient:
+            _WINDOW = max(1.0, _WINDOW / 2)
+        elif transient is None:
+            # Pushes taking much longer than usual mean that the server is busy
+            if _LATENCY is not None and latency > 2 * _LATENCY:
+                _WINDOW = max(1.0, _WINDOW * 0.75)
+            else:
+                _WINDOW = min(float(max_concurrency), _WINDOW + 1 / _WINDOW)
+            _LATENCY = latency if _LATENCY is None else 0.8 * _LATENCY + 0.2 * latency
+        _CONDITION.notify_all()
+
+
+def print_retry_report(results):
+    retried = [r for r in results if r["attempts"] > 1]
+    failed = [r for r in results if not r["success"]]
+    if len(retried) == 0 and len(failed) == 0:
+        return
+
+    recovered = len([r for r in retried if r["success"]])
+    print(
+        f"\nPush report: {len(retried)} pushes retried, {recovered} of them succeeded, "
+        f"{len(failed)} failed (concurrency: {_WINDOW:.1f})"
+    )
+    for r in failed:
+        print(f"  {r['name']} ({r['attempts']} attempts): {r['error']}")
+
+
+def print_identical_report(pushes, results):
+    identical = [(p, r) for p, r in zip(pushes, results) if "identical" in r]
+    if len(identical) == 0:
+        return
+
+    size = 0
+    for p, r in identical:
+        size += r["size"]
+        metrics.add("crowdin_sync_avoided_push_bytes", r["size"], branch=p["branch"])
+    print(
+        f"\nSkipped {len(identical)} pushes identical to open changes, "
+        f"avoiding {len(identical)} gerrit updates and about {size / 1024:.1f} KiB "
+        f"of push traffic"
+    )
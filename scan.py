@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# scan.py
+#
+# Scans all translation files of a branch for problems which break aapt2,
+# before they are committed
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import utils
+
+# values-de, values-pt-rBR and values-b+sr+Latn, but not e.g. values-land or values-v21
+_LOCALE_DIR = re.compile(r"^values-([a-z]{2,3}(-r[A-Z]{2})?|b\+[A-Za-z0-9+]+)$")
+_RESOURCE_TAGS = {"string", "string-array", "plurals"}
+
+# Problems which clean_xml_file() fixes and the ones which need a human
+_CHECKS = {
+    "malformed": "Malformed XML, would be reset",
+    "empty": "No translated strings, would be removed",
+    "missing_default": "Strings with a product but without product=default",
+    "not_translatable": "Strings marked translatable=false",
+    "duplicate": "Duplicate strings, which aapt2 rejects (not fixable)",
+}
+_FIXABLE = ["malformed", "empty", "missing_default", "not_translatable"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Scan the translation files of a branch for problems breaking aapt2"
+    )
+    parser.add_argument("-b", "--branch", required=True, help="LineageOS branch")
+    parser.add_argument("-c", "--config", help="Custom yaml config")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes parsing the files (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--fix",
+        action="store_true",
+        help="Clean the files with problems like a download would",
+    )
+    return parser.parse_args()
+
+
+# ################################### SCAN ################################### #
+
+
+def get_translation_files(base_path, config_dict):
+    # Expand the translation patterns of the configs to the files in the tree
+    files = set()
+    for cfg in config_dict["files"]:
+        for f in utils.load_config(cfg)["files"]:
+            pattern = (
+                f["translation"]
+                .lstrip("/")
+                .replace("%android_code%", "*")
+                .replace("%original_file_name%", os.path.basename(f["source"]))
+            )
+            for path in glob.glob(os.path.join(base_path, pattern)):
+                if _LOCALE_DIR.match(os.path.basename(os.path.dirname(path))):
+                    files.add(path)
+    return sorted(files)
+
+
+def parse_file(path):
+    # Runs in the worker processes, returns an error or the rows of the top level
+    # resources of the file as (tag, name, product, translatable)
+    from lxml import etree
+
+    rows = []
+    try:
+        for event, elem in etree.iterparse(path, events=("end",)):
+            parent = elem.getparent()
+            if parent is None or parent.getparent() is not None:
+                continue
+            if elem.tag in _RESOURCE_TAGS:
+                rows.append(
+                    (
+                        elem.tag,
+                        elem.get("name"),
+                        elem.get("product"),
+                        elem.get("translatable") != "false",
+                    )
+                )
+            elem.clear()
+    except etree.XMLSyntaxError as e:
+        return str(e), []
+    return None, rows
+
+
+def build_table(paths, jobs):
+    # One column per attribute, the file column holds indexes into paths
+    table = {
+        "file": [],
+        "locale": [],
+        "tag": [],
+        "name": [],
+        "product": [],
+        "translatable": [],
+    }
+    errors = {}
+    locales = [os.path.basename(os.path.dirname(p))[len("values-") :] for p in paths]
+    chunksize = max(1, len(paths) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(parse_file, paths, chunksize=chunksize)
+        for i, (error, rows) in enumerate(results):
+            if error is not None:
+                errors[i] = error
+                continue
+            table["file"] += [i] * len(rows)
+            table["locale"] += [locales[i]] * len(rows)
+            for k, column in enumerate(["tag", "name", "product", "translatable"]):
+                table[column] += [row[k] for row in rows]
+    return table, errors
+
+
+def run_checks(table, errors, file_count):
+    # Every check works on whole columns at once, returns (file, detail) per check
+    problems = {check: [] for check in _CHECKS}
+    problems["malformed"] = sorted(errors.items())
+
+    files_with_rows = set(table["file"])
+    problems["empty"] = [
+        (i, None)
+        for i in range(file_count)
+        if i not in files_with_rows and i not in errors
+    ]
+
+    strings = [
+        (f, name, product)
+        for f, tag, name, product in zip(
+            table["file"], table["tag"], table["name"], table["product"]
+        )
+        if tag == "string"
+    ]
+    has_default = {
+        (f, name) for f, name, product in strings if product in (None, "default")
+    }
+    has_product = {
+        (f, name) for f, name, product in strings if product not in (None, "default")
+    }
+    problems["missing_default"] = sorted(has_product - has_default)
+
+    problems["not_translatable"] = sorted(
+        {
+            (f, name)
+            for f, name, translatable in zip(
+                table["file"], table["name"], table["translatable"]
+            )
+            if not translatable
+        }
+    )
+
+    counts = Counter(zip(table["file"], table["tag"], table["name"], table["product"]))
+    problems["duplicate"] = sorted(
+        {(f, name) for (f, tag, name, product), count in counts.items() if count > 1}
+    )
+    return problems
+
+
+# ################################### MAIN ################################### #
+
+
+def print_report(problems, paths, base_path):
+    for check, found in problems.items():
+        if len(found) == 0:
+            continue
+        files = {f for f, detail in found}
+        print(f"\n{_CHECKS[check]}: {len(found)} in {len(files)} files")
+        for f, detail in found:
+            path = os.path.relpath(paths[f], base_path)
+            print(f"  {path}" if detail is None else f"  {path}: {detail}")
+
+
+def fix_files(problems, paths):
+    import download
+    import git
+
+    files = sorted({f for check in _FIXABLE for f, detail in problems[check]})
+    malformed = {f for f, detail in problems["malformed"]}
+    print(f"\nFixing {len(files)} files")
+    for f in files:
+        # Malformed files are reset to their committed state
+        try:
+            repo = git.Repo(os.path.dirname(paths[f]), search_parent_directories=True)
+        except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+            if f in malformed:
+                print(f"Can't reset {paths[f]}, not in a git repository")
+                continue
+            repo = None
+        download.clean_xml_file(paths[f], repo)
+
+
+def main():
+    args = parse_args()
+    base_path = utils.get_base_path(args.branch)
+    config_dict = utils.get_config_dict(args.config, args.branch)
+
+    start = time.monotonic()
+    paths = get_translation_files(base_path, config_dict)
+    table, errors = build_table(paths, max(1, args.jobs))
+    parsed = time.monotonic()
+    problems = run_checks(table, errors, len(paths))
+    checked = time.monotonic()
+
+    print(
+        f"Scanned {len(paths)} files with {len(table['name'])} strings in "
+        f"{len({os.path.dirname(p).split('values-')[-1] for p in paths})} locales (parsing {parsed - start:.2f}s, "
+        f"checks {checked - parsed:.2f}s)"
+    )
+    print_report(problems, paths, base_path)
+
+    remaining = [c for c in _CHECKS if len(problems[c]) > 0]
+    if args.fix:
+        fix_files(problems, paths)
+        remaining = [c for c in remaining if c not in _FIXABLE]
+    if len(remaining) > 0:
+        sys.exit(1)
+    print("\nNo problems left")
+
+
+if __name__ == "__main__":
+    main()
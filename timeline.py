@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# timeline.py
+#
+# Helper script for recording a timeline of a run in the Chrome trace event
+# format, which can be viewed in Perfetto or chrome://tracing
+#
+# Copyright (C) 2026 The LineageOS Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Nothing is recorded unless a trace file was given
+_LOCK = threading.Lock()
+_EVENTS = None
+_THREADS = {}
+_START = time.monotonic()
+
+
+def enable(path):
+    # Write the trace when the run ends, no matter where it exits
+    global _EVENTS
+    _EVENTS = []
+    atexit.register(write, path)
+
+
+def add_span(name, category, start, end=None, **args):
+    # start and end are time.monotonic() timestamps
+    if _EVENTS is None:
+        return
+    if end is None:
+        end = time.monotonic()
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": round((start - _START) * 1e6),
+        "dur": round((end - start) * 1e6),
+        "pid": os.getpid(),
+        "tid": get_thread_id(),
+    }
+    if args:
+        event["args"] = args
+    with _LOCK:
+        _EVENTS.append(event)
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    start = time.monotonic()
+    try:
+        yield args
+    finally:
+        add_span(name, category, start, **args)
+
+
+def get_thread_id():
+    # Small ids are easier to read, the thread names are added as metadata
+    ident = threading.get_ident()
+    with _LOCK:
+        if ident not in _THREADS:
+            _THREADS[ident] = len(_THREADS) + 1
+            _EVENTS.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": _THREADS[ident],
+                    "args": {"name": threading.current_thread().name},
+                }
+            )
+        return _THREADS[ident]
+
+
+def write(path):
+    with _LOCK:
+        events = list(_EVENTS)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fh)
+    os.replace(tmp_path, path)
+    print(f"Wrote {len(events)} trace events to {path}")
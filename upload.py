@@ -20,34 +20,99 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fnmatch
+import git
+import metrics
+import os
+import time
 import utils
 import sys
 
 _HAS_UPLOADED = False
 
 
-def upload_sources_crowdin(branch, config_dict, crowdin_path):
+def upload_sources_crowdin(branch, config_dict, crowdin_path, base_path):
     global _HAS_UPLOADED
+    state_name = f"{branch}_sources"
+    state = utils.load_state(state_name)
+    start = time.monotonic()
     for i, cfg in enumerate(config_dict["files"]):
         print(f"\nUploading sources to Crowdin ({config_dict['headers'][i]})")
+        cfg_name = os.path.basename(cfg)
+        files = utils.load_config(cfg)["files"]
+        hashes = get_source_hashes(files, base_path)
+        changed = get_changed_sources(files, hashes, state.get(cfg_name, {}))
+        if len(changed) == 0:
+            print("No source file changed, skipping")
+            continue
+
+        # Only upload what actually changed
+        tmp_cfg = None
+        if len(changed) < len(files):
+            print(f"{len(changed)} of {len(files)} source files changed")
+            tmp_cfg = utils.write_config(cfg, changed)
+
         cmd = [
             crowdin_path,
             "upload",
             "sources",
             f"--branch={branch}",
-            f"--config={cfg}",
+            f"--config={tmp_cfg or cfg}",
         ]
-        comm, ret = utils.run_subprocess(cmd, show_spinner=True)
+        comm, ret = utils.run_subprocess(cmd, stage=f"{branch} crowdin upload sources")
+        if tmp_cfg is not None:
+            os.remove(tmp_cfg)
         if ret != 0:
+            metrics.add("crowdin_sync_errors", branch=branch, service="crowdin")
             print(f"Failed to upload:\n{comm[1]}", file=sys.stderr)
             sys.exit(1)
-    _HAS_UPLOADED = True
+
+        state[cfg_name] = hashes
+        utils.save_state(state_name, state)
+        _HAS_UPLOADED = True
+    metrics.add_duration(branch, "upload_sources", start)
+
+
+def get_source_hashes(files, base_path):
+    hashes = {}
+    for f in files:
+        source = f["source"]
+        hashes[source] = utils.hash_file(os.path.join(base_path, source.lstrip("/")))
+    return hashes
 
 
-def upload_translations_crowdin(branch, config_dict, crowdin_path):
+def get_changed_sources(files, hashes, old_hashes):
+    # Missing files are always considered changed, so crowdin can complain about them
+    changed = []
+    for f in files:
+        source = f["source"]
+        if hashes[source] is None or hashes[source] != old_hashes.get(source):
+            changed.append(f)
+    return changed
+
+
+def upload_translations_crowdin(
+    branch, config_dict, crowdin_path, base_path, xml=None, changed_only=False
+):
     global _HAS_UPLOADED
+    state_name = f"{branch}_translations"
+    state = utils.load_state(state_name)
+    items = utils.get_projects(xml) if changed_only else []
+    projects = {}
+    start = time.monotonic()
     for i, cfg in enumerate(config_dict["files"]):
         print(f"\nUploading translations to Crowdin ({config_dict['headers'][i]})")
+        tmp_cfg = None
+        if changed_only:
+            files = utils.load_config(cfg)["files"]
+            changed = get_changed_translations(files, base_path, items, state, projects)
+            if len(changed) == 0:
+                print("No translation changed, skipping")
+                continue
+            if len(changed) < len(files):
+                print(f"Translations of {len(changed)} of {len(files)} files changed")
+                tmp_cfg = utils.write_config(cfg, changed)
+
         cmd = [
             crowdin_path,
             "upload",
@@ -56,13 +121,82 @@ def upload_translations_crowdin(branch, config_dict, crowdin_path):
             "--no-translate-hidden",
             "--import-eq-suggestions",
             "--auto-approve-imported",
-            f"--config={cfg}",
+            f"--config={tmp_cfg or cfg}",
         ]
-        comm, ret = utils.run_subprocess(cmd, show_spinner=True)
+        comm, ret = utils.run_subprocess(
+            cmd, stage=f"{branch} crowdin upload translations"
+        )
+        if tmp_cfg is not None:
+            os.remove(tmp_cfg)
         if ret != 0:
+            metrics.add("crowdin_sync_errors", branch=branch, service="crowdin")
             print(f"Failed to upload:\n{comm[1]}", file=sys.stderr)
             sys.exit(1)
-    _HAS_UPLOADED = True
+        _HAS_UPLOADED = True
+    metrics.add_duration(branch, "upload_translations", start)
+
+    # Remember which revision of each project was uploaded, so the next run can be incremental
+    if changed_only:
+        for project_path, (repo, changed_files) in projects.items():
+            if repo is not None:
+                state[project_path] = repo.head.commit.hexsha
+        utils.save_state(state_name, state)
+
+
+def get_changed_translations(files, base_path, items, state, projects):
+    # projects is shared by all configs, since several of them can map files to the same
+    # project (e.g. vendor/crowdin). It holds the repo and the changed files by path.
+    changed = []
+    for f in files:
+        translation = f["translation"].strip("/")
+        project = utils.find_project(items, translation)
+        if project is None:
+            # We can't tell, so better upload it
+            changed.append(f)
+            continue
+
+        project_path = project.get("path")
+        if project_path not in projects:
+            repo = get_repo(os.path.join(base_path, project_path))
+            projects[project_path] = (
+                repo,
+                get_changed_files(repo, state.get(project_path)),
+            )
+        changed_files = projects[project_path][1]
+
+        # Match the changed files against the translation pattern of this file
+        pattern = (
+            translation[len(project_path) + 1 :]
+            .replace("%android_code%", "*")
+            .replace("%original_file_name%", os.path.basename(f["source"]))
+        )
+        if changed_files is None or any(
+            fnmatch.fnmatch(x, pattern) for x in changed_files
+        ):
+            changed.append(f)
+    return changed
+
+
+def get_repo(path):
+    try:
+        return git.Repo(path)
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+        print(f"WARNING: {path} is not a git repository", file=sys.stderr)
+        return None
+
+
+def get_changed_files(repo, revision):
+    # None means that everything has to be considered as changed
+    if repo is None or revision is None:
+        return None
+    try:
+        # Compare the last uploaded revision against the working tree
+        modified = repo.git.diff("--name-only", revision, "--").split("\n")
+        untracked = repo.git.ls_files(o=True, exclude_standard=True).split("\n")
+    except git.GitCommandError as e:
+        print(e, f"Failed to diff against {revision}", file=sys.stderr)
+        return None
+    return [x for x in modified + untracked if x]
 
 
 def has_uploaded():
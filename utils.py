@@ -19,24 +19,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import itertools
+import argparse
+import functools
+import hashlib
+import json
 import os
+import re
 import sys
+import tempfile
+import time
 
-from lxml import etree
-from threading import Thread
-from time import sleep
 from subprocess import Popen, PIPE
 
-_DIR = os.path.dirname(os.path.realpath(__file__))
-_DONE = False
-
+import metrics
+import progress
+import timeline
 
-def run_subprocess(cmd, silent=False, show_spinner=False):
-    t = start_spinner(show_spinner)
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    comm = p.communicate()
+_DIR = os.path.dirname(os.path.realpath(__file__))
+_INTERRUPTED = False
+_XML_CACHE = {}
+_SSH_PERSIST = 60
+
+
+def run_subprocess(cmd, silent=False, stage=None, stdin=None, env=None):
+    # If a stage is given, its duration is shown while waiting for the command
+    if stage is not None:
+        progress.start(stage)
+    metrics.add("crowdin_sync_subprocesses", command=os.path.basename(cmd[0]))
+    start = time.monotonic()
+    p = Popen(
+        cmd,
+        stdin=None if stdin is None else PIPE,
+        stdout=PIPE,
+        stderr=PIPE,
+        env=env,
+        universal_newlines=True,
+    )
+    comm = p.communicate(stdin)
     exit_code = p.returncode
+    timeline.add_span(
+        get_command_name(cmd),
+        os.path.basename(cmd[0]),
+        start,
+        cmd=" ".join(cmd),
+        exit_code=exit_code,
+    )
+    if stage is not None:
+        progress.finish(stage)
     if exit_code != 0 and not silent:
         print(
             "There was an error running the subprocess.\n"
@@ -46,38 +75,19 @@ def run_subprocess(cmd, silent=False, show_spinner=False):
             "stderr: %s" % (cmd, exit_code, comm[0], comm[1]),
             file=sys.stderr,
         )
-    stop_spinner(t)
     return comm, exit_code
 
 
-def start_spinner(show_spinner):
-    global _DONE
-    _DONE = False
-    if not show_spinner:
-        return None
-    t = Thread(target=spin_cursor)
-    t.start()
-    return t
-
-
-def stop_spinner(t):
-    global _DONE
-    if t is None:
-        return
-    _DONE = True
-    t.join(1)
-
-
-def spin_cursor():
-    global _DONE
-    spinner = itertools.cycle([".", "..", "...", "....", "....."])
-    while not _DONE:
-        sys.stdout.write("\x1b[1K\r")
-        output = next(spinner)
-        sys.stdout.write(output)
-        sys.stdout.flush()
-        sleep(0.5)
-    sys.stdout.write("\x1b[1K\r     ")
+def get_command_name(cmd):
+    # e.g. "git push" or "gerrit query"
+    name = os.path.basename(cmd[0])
+    args = cmd[1:]
+    if name == "ssh" and "gerrit" in args:
+        return " ".join(args[args.index("gerrit") :][:2])
+    for i, arg in enumerate(args):
+        if not arg.startswith("-") and (i == 0 or args[i - 1] != "-C"):
+            return f"{name} {arg}"
+    return name
 
 
 def check_run(cmd):
@@ -89,6 +99,15 @@ def check_run(cmd):
         sys.exit(ret)
 
 
+def set_interrupted():
+    global _INTERRUPTED
+    _INTERRUPTED = True
+
+
+def is_interrupted():
+    return _INTERRUPTED
+
+
 def find_xml(base_path):
     for dp, dn, file_names in os.walk(base_path):
         for f in file_names:
@@ -98,7 +117,7 @@ def find_xml(base_path):
 
 def get_username(args):
     username = args.username
-    if (args.gerrit or args.download or args.unzip) and username is None:
+    if (args.gerrit or args.download or args.unzip or args.resume) and username is None:
         # try getting the username from git
         msg, code = run_subprocess(
             ["git", "config", "--get", "review.review.lineageos.org.username"],
@@ -143,14 +162,29 @@ def check_dependencies():
 
 
 def load_xml(x):
+    from lxml import etree
+
+    # Manifests are only read, so parse them again only if they changed
+    try:
+        st = os.stat(x)
+        stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        stamp = None
+    cached = _XML_CACHE.get(x)
+    if stamp is not None and cached is not None and cached[0] == stamp:
+        return cached[1]
+
     try:
-        return etree.parse(x)
+        xml = etree.parse(x)
     except etree.XMLSyntaxError:
         print(f"Malformed {x}", file=sys.stderr)
         return None
     except Exception:
         print(f"You have no {x}", file=sys.stderr)
         return None
+    if stamp is not None:
+        _XML_CACHE[x] = (stamp, xml)
+    return xml
 
 
 def check_files(files):
@@ -193,6 +227,94 @@ def get_xml_files(base_path, default_branch):
     return xml_files
 
 
+def get_projects(xml):
+    return [x for xml_file in xml for x in xml_file.findall("//project")]
+
+
+def find_project(projects, project_path):
+    # Search android/default.xml or config/%(branch)_extra_packages.xml
+    # for the project containing the given path
+    result = None
+    for project in projects:
+        path = project.get("path")
+        if not (project_path + "/").startswith(path + "/"):
+            continue
+        # We want the longest match, so projects in subfolders of other projects are also
+        # taken into account
+        if result is None or len(path) > len(result.get("path")):
+            result = project
+    return result
+
+
+def get_scope(args, xml):
+    # Limits a sync to some languages and projects, None if everything is synced
+    if not args.languages and not args.projects:
+        return None
+
+    scope = {"languages": args.languages, "folders": None, "projects": None}
+    if args.languages:
+        # Crowdin's pt-BR is values-pt-rBR on Android, accept both
+        scope["folders"] = set()
+        for lang in args.languages:
+            scope["folders"].add(f"values-{lang}")
+            if "-" in lang:
+                language, region = lang.split("-", 1)
+                scope["folders"].add(f"values-{language}-r{region}")
+    if args.projects:
+        items = get_projects(xml)
+        scope["items"] = items
+        scope["projects"] = set()
+        for p in args.projects:
+            paths = [
+                x.get("path") for x in items if p in (x.get("name"), x.get("path"))
+            ]
+            if len(paths) == 0:
+                print(f"Project {p} not found in the manifest", file=sys.stderr)
+                sys.exit(1)
+            scope["projects"].update(paths)
+    return scope
+
+
+def in_scope(scope, path):
+    # path is a translation file, relative to the base path
+    if scope is None:
+        return True
+    if scope["folders"] is not None:
+        if os.path.basename(os.path.dirname(path)) not in scope["folders"]:
+            return False
+    return in_scope_projects(scope, path)
+
+
+def in_scope_projects(scope, path):
+    if scope is None or scope["projects"] is None:
+        return True
+    path = path.strip().strip("/")
+    if not any((path + "/").startswith(p + "/") for p in scope["projects"]):
+        return False
+    # The file might belong to a project nested in the selected one
+    return find_project(scope["items"], path).get("path") in scope["projects"]
+
+
+def parse_shard(value):
+    # Shards are given as i/n, with 1 <= i <= n
+    try:
+        index, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}', expected i/n")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            f"invalid shard '{value}', expected 1 <= i <= n"
+        )
+    return index, count
+
+
+def in_shard(project_path, shard):
+    # Use a stable hash, so every host gets the same partitions
+    index, count = shard
+    digest = hashlib.sha1(project_path.encode("utf-8")).hexdigest()
+    return int(digest, 16) % count == index - 1
+
+
 def get_config_dict(config, default_branch):
     config_dict = {}
     if config:
@@ -212,6 +334,99 @@ def get_config_dict(config, default_branch):
     return config_dict
 
 
+# The configs are shared between all branches of a run, so only parse them once.
+# Don't modify the returned dict!
+@functools.lru_cache(maxsize=None)
+def load_config(config):
+    import yaml
+
+    with open(config, "r") as fh:
+        return yaml.safe_load(fh)
+
+
+def write_config(config, files):
+    import yaml
+
+    # Write a copy of the given crowdin config, only containing the given files
+    config_yaml = dict(load_config(config), files=files)
+    fd, path = tempfile.mkstemp(prefix="crowdin_", suffix=".yaml")
+    with os.fdopen(fd, "w") as fh:
+        yaml.safe_dump(config_yaml, fh, sort_keys=False)
+    return path
+
+
+def get_state_dir():
+    state_dir = os.getenv("LINEAGE_CROWDIN_STATE_DIR", f"{_DIR}/.state")
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def load_state(name):
+    path = os.path.join(get_state_dir(), f"{name}.json")
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, "r") as fh:
+            return json.load(fh)
+    except ValueError:
+        print(f"Ignoring corrupt state file {path}", file=sys.stderr)
+        return {}
+
+
+def save_state(name, state):
+    path = os.path.join(get_state_dir(), f"{name}.json")
+    # Write to a temporary file first, so an interrupted run can't corrupt the state
+    with open(path + ".tmp", "w") as fh:
+        json.dump(state, fh, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+@functools.lru_cache(maxsize=None)
+def get_git_version():
+    # e.g. (2, 39) for "git version 2.39.5", (0, 0) if it can't be determined
+    comm, ret = run_subprocess(["git", "--version"], silent=True)
+    match = re.search(r"(\d+)\.(\d+)", comm[0])
+    if ret != 0 or match is None:
+        return 0, 0
+    return int(match.group(1)), int(match.group(2))
+
+
+def hash_file(path, git_blob=False):
+    # With git_blob, the hash is the object id git gives the file
+    if not os.path.isfile(path):
+        return None
+    h = hashlib.sha1()
+    if git_blob:
+        h.update(f"blob {os.path.getsize(path)}\0".encode())
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_ssh_options():
+    # Share one connection to gerrit between all ssh and git processes of a run
+    control_path = os.path.join(tempfile.gettempdir(), "lineage-crowdin-%C")
+    return [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={control_path}",
+        "-o",
+        f"ControlPersist={_SSH_PERSIST}",
+    ]
+
+
+def enable_ssh_multiplexing(persist=60):
+    # Keep the connection open for the given seconds after its last use
+    global _SSH_PERSIST
+    _SSH_PERSIST = persist
+    # Don't override what the user explicitly configured
+    if "GIT_SSH_COMMAND" not in os.environ:
+        os.environ["GIT_SSH_COMMAND"] = " ".join(["ssh"] + get_ssh_options())
+
+
 def get_gerrit_base_cmd(username):
-    cmd = ["ssh", "-p", "29418", f"{username}@review.lineageos.org", "gerrit"]
+    cmd = ["ssh"] + get_ssh_options()
+    cmd += ["-p", "29418", f"{username}@review.lineageos.org", "gerrit"]
     return cmd
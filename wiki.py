@@ -18,15 +18,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
-import requests
-
 from html import escape
 
-import utils
+import crowdin_api
+import progress
 
-crowdin_url = "https://api.crowdin.com/api/v2/projects"
-token = None
+crowdin_url = f"{crowdin_api.crowdin_url}/projects"
 
 # These people are global proofreaders / managers and wouldn't appear for their languages otherwise
 users_to_append = {
@@ -44,14 +41,14 @@ users_to_append = {
 
 def generate_wiki_list(config_files):
     print("\nGenerating proofreader list")
-    t = utils.start_spinner(True)
+    progress.start("Crowdin API")
 
     project_ids = get_project_ids(config_files)
     languages = get_languages(project_ids)
     managers = get_managers(project_ids)
     global_proofreaders, proofreaders = get_proofreaders(project_ids, languages)
 
-    utils.stop_spinner(t)
+    progress.finish("Crowdin API")
 
     generate_output(managers, global_proofreaders, proofreaders)
 
@@ -106,7 +103,11 @@ def get_project_ids(config_files):
 
 
 def get_from_api(url):
-    resp = requests.get(url, headers=get_headers())
+    try:
+        resp = crowdin_api.get_session().get(url)
+    except RuntimeError as e:
+        print(e)
+        exit(-1)
     if resp.status_code != 200:
         print(f"Error retrieving data - {resp.json()}")
         exit(-1)
@@ -123,24 +124,6 @@ def get_languages(project_ids):
     return languages
 
 
-def get_headers():
-    global token
-    if token is None:
-        get_access_token()
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token}"}
-    return headers
-
-
-def get_access_token():
-    global token
-    token = os.getenv("LINEAGE_CROWDIN_API_TOKEN")
-    if token is None:
-        print(
-            "Could not determine api token, please export LINEAGE_CROWDIN_API_TOKEN to the environment!"
-        )
-        exit(-1)
-
-
 def get_managers(project_ids):
     managers = []
     for project_id in project_ids: